@@ -0,0 +1,80 @@
+import asyncio
+import curses
+import sys
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+@contextmanager
+def curses_screen():
+    """Set up the terminal like curses.wrapper, without taking over the event loop"""
+    stdscr = curses.initscr()
+    try:
+        curses.noecho()
+        curses.cbreak()
+        stdscr.keypad(True)
+        stdscr.nodelay(True)  # getch() returns -1 instead of blocking
+        try:
+            curses.start_color()
+            curses.use_default_colors()
+        except curses.error:
+            pass
+        yield stdscr
+    finally:
+        stdscr.keypad(False)
+        curses.echo()
+        curses.nocbreak()
+        curses.endwin()
+
+
+class KeyReader:
+    """Await key presses on a non-blocking curses window.
+
+    stdin is watched with loop.add_reader, so other tasks keep running
+    while no key is pressed. read() can also be woken up early through an
+    asyncio.Event, e.g. when background work has new content to draw.
+    """
+
+    def __init__(self, stdscr, fd: Optional[int] = None):
+        self.stdscr = stdscr
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self._readable = asyncio.Event()
+        self._loop = None
+
+    def __enter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.fd, self._readable.set)
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.remove_reader(self.fd)
+
+    def _drain(self) -> List[int]:
+        keys = []
+        while True:
+            try:
+                key = self.stdscr.getch()
+            except curses.error:
+                break
+            if key == -1:
+                break
+            keys.append(key)
+        return keys
+
+    async def read(self, wakeup: Optional[asyncio.Event] = None) -> List[int]:
+        """Wait for input or for wakeup; return the keys pressed, possibly none"""
+        keys = self._drain()
+        if keys:
+            return keys
+        waiters = [asyncio.ensure_future(self._readable.wait())]
+        if wakeup is not None:
+            waiters.append(asyncio.ensure_future(wakeup.wait()))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        self._readable.clear()
+        if wakeup is not None:
+            wakeup.clear()
+        return self._drain()
@@ -0,0 +1,172 @@
+import asyncio
+import io
+import os
+import sys
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from exporter import EXPORT_FORMATS
+from instrumentation import stats
+from telegram_utils import CHAT_COMMANDS
+
+# Chats whose commands run at the same time on the shared connection
+BATCH_PARALLELISM = int(os.getenv('BATCH_PARALLELISM', '4'))
+
+# Exit codes of `main.py batch`
+EXIT_OK = 0
+EXIT_FAILED = 1  # A command failed
+EXIT_USAGE = 2  # Bad arguments, as argparse uses
+EXIT_NOT_FOUND = 3  # A chat could not be found, all commands otherwise succeeded
+EXIT_UNAUTHORIZED = 4  # The session has to log in interactively first
+
+# Commands that need a terminal
+INTERACTIVE_COMMANDS = ('/view', '/send', '/back', '/list')
+# Commands taking a message count, and ones that take no arguments
+COUNT_COMMANDS = ('/read', '/summarize', '/add')
+PLAIN_COMMANDS = ('/digest', '/show', '/clear', '/help')
+# Commands that do not depend on the chat, run once per batch
+GLOBAL_COMMANDS = ('/digest', '/searchall')
+
+# Handles one command for a chat like main.handle_chat_commands, returning
+# 'ok', 'usage', 'error' or 'unknown'
+CommandHandler = Callable[[str, object, object], Awaitable[str]]
+ChatResolver = Callable[[object, str], Awaitable[Optional[object]]]
+
+_output: ContextVar[Optional[io.StringIO]] = ContextVar('batch_output', default=None)
+
+
+class TaskOutput(io.TextIOBase):
+    """Stand-in for sys.stdout that sends what a task prints to its own buffer.
+
+    The buffer is taken from a context variable, which every asyncio task
+    copies when it is created, so output stays with the command that
+    produced it however the chats interleave. Without a buffer, text goes
+    to the real stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        buffer = _output.get()
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        if _output.get() is None:
+            self.stream.flush()
+
+    def isatty(self) -> bool:
+        return False
+
+
+def clean_output(text: str) -> str:
+    """Captured output with progress lines reduced to their final state"""
+    return "\n".join(line.rsplit("\r", 1)[-1] for line in text.split("\n")).strip()
+
+
+def check_command(cmd: str) -> Optional[str]:
+    """Why cmd cannot run in a batch, or None if it can"""
+    name, _, argument = cmd.strip().partition(" ")
+    args = argument.split()
+    if name not in CHAT_COMMANDS:
+        return f"unknown command {name!r}"
+    if name in INTERACTIVE_COMMANDS:
+        return f"{name} needs the interactive client"
+    if name in COUNT_COMMANDS and not (len(args) == 1 and args[0].isdigit()):
+        return f"{name} needs a number of messages, e.g. \"{name} 100\""
+    if name == "/export" and (len(args) > 1 or (args and args[0] not in EXPORT_FORMATS)):
+        return f"/export takes an optional format, one of {', '.join(EXPORT_FORMATS)}"
+    if name == "/download" and (len(args) > 1 or (args and not args[0].isdigit())):
+        return "/download takes an optional message id"
+    if name in ("/search", "/searchall") and not args:
+        return f"{name} needs a query"
+    if name == "/prompt" and not args:
+        return "/prompt needs the question inline, e.g. \"/prompt what was decided?\""
+    if name == "/stats" and args not in ([], ["reset"]):
+        return "/stats takes no arguments or reset"
+    if name in PLAIN_COMMANDS and args:
+        return f"{name} takes no arguments"
+    return None
+
+
+async def run_command(cmd: str, client, entity, handler: CommandHandler) -> Dict:
+    buffer = io.StringIO()
+    token = _output.set(buffer)
+    started = time.perf_counter()
+    try:
+        with stats.timer(f"command {cmd.split()[0]}.seconds"):
+            status = await handler(cmd, client, entity)
+    except Exception as e:
+        print(f"Error running {cmd.split()[0]}: {str(e)}")
+        status = 'error'
+    finally:
+        _output.reset(token)
+    return {'command': cmd, 'status': status, 'seconds': round(time.perf_counter() - started, 3),
+            'output': clean_output(buffer.getvalue())}
+
+
+async def run_chat(chat: str, commands: List[str], client, handler: CommandHandler,
+                   resolve: ChatResolver) -> Dict:
+    """Run commands one after another in chat, with an LLM context of its own"""
+    from llm_utils import use_own_context
+    use_own_context()  # Only seen by this chat's task
+    try:
+        entity = await resolve(client, chat)
+    except Exception as e:
+        return {'chat': chat, 'status': 'failed', 'error': str(e), 'commands': []}
+    if entity is None:
+        return {'chat': chat, 'status': 'not_found', 'commands': []}
+    results = [await run_command(cmd, client, entity, handler) for cmd in commands]
+    failed = any(result['status'] != 'ok' for result in results)
+    return {'chat': chat, 'id': entity.id,
+            'name': getattr(entity, 'title', None) or getattr(entity, 'first_name', None),
+            'status': 'failed' if failed else 'ok', 'commands': results}
+
+
+async def run_batch(client, chats: List[str], commands: List[str], handler: CommandHandler,
+                    resolve: ChatResolver, parallelism: int = BATCH_PARALLELISM) -> Dict:
+    """Run commands in every chat and return the results as a JSON-ready dict.
+
+    Commands in GLOBAL_COMMANDS run once, before the chats. Chats run
+    concurrently, up to parallelism at a time, all on the one client; the
+    commands of a chat run in order, and each chat has its own LLM
+    context. What each command prints is captured and returned as its
+    output.
+    """
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    started = time.perf_counter()
+    done = 0
+    once = [cmd for cmd in commands if cmd.split()[0] in GLOBAL_COMMANDS]
+    commands = [cmd for cmd in commands if cmd.split()[0] not in GLOBAL_COMMANDS]
+
+    async def run(chat: str) -> Dict:
+        nonlocal done
+        async with semaphore:
+            result = await run_chat(chat, commands, client, handler, resolve)
+        done += 1
+        print(f"{chat}: {result['status']} ({done}/{len(chats)})", file=sys.stderr, flush=True)
+        return result
+
+    stdout = sys.stdout
+    sys.stdout = TaskOutput(stdout)
+    try:
+        once_results = []
+        for cmd in once:
+            once_results.append(await run_command(cmd, client, None, handler))
+            print(f"{cmd}: {once_results[-1]['status']}", file=sys.stderr, flush=True)
+        results = await asyncio.gather(*(run(chat) for chat in chats))
+    finally:
+        sys.stdout = stdout
+    statuses = {result['status'] for result in results}
+    if any(result['status'] != 'ok' for result in once_results):
+        statuses.add('failed')
+    if 'failed' in statuses:
+        exit_code = EXIT_FAILED
+    elif 'not_found' in statuses:
+        exit_code = EXIT_NOT_FOUND
+    else:
+        exit_code = EXIT_OK
+    return {'started': started_at, 'seconds': round(time.perf_counter() - started, 3),
+            'exit_code': exit_code, 'commands': once_results, 'chats': list(results)}
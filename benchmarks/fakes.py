@@ -0,0 +1,229 @@
+"""Offline stand-ins for Telegram, Ollama and the terminal used by the benchmarks"""
+import asyncio
+import curses
+import json
+import random
+import socket
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import List, Optional
+
+from aiohttp import web
+from telethon.helpers import TotalList
+from telethon.tl.types import Channel, ChatPhotoEmpty
+
+WORDS = ("the meeting moved to friday please check the new build numbers look good "
+         "who has the keys deploy failed again lunch anyone release notes are ready "
+         "thanks see you tomorrow sounds great link to the doc").split()
+
+START_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+PAGE = 100  # Messages per GetHistory request, as in Telethon
+
+
+def fake_channel(chat_id: int = 1234, title: str = "Benchmark chat") -> Channel:
+    return Channel(id=chat_id, title=title, photo=ChatPhotoEmpty(), date=START_DATE,
+                   access_hash=1, version=0)
+
+
+class FakeTelegramClient:
+    """Serves one synthetic chat of n messages through Telethon's reading API.
+
+    Messages are generated from their id on demand, so even large chats
+    cost no memory. senders sets how many people write; attached is the
+    share of messages that come with their sender already resolved, the
+    rest make the sender cache call get_entity. rtt is the simulated
+    round-trip time of every page of history and every get_entity call.
+    """
+
+    def __init__(self, n: int, senders: int = 20, attached: float = 0.5,
+                 words: int = 12, rtt: float = 0.0, seed: int = 0):
+        self.n = n
+        self.senders = senders
+        self.attached = attached
+        self.words = words
+        self.rtt = rtt
+        self.seed = seed
+        self.requests = 0
+
+    def message(self, msg_id: int):
+        rng = random.Random(self.seed * 1_000_003 + msg_id)
+        sender_id = 1000 + rng.randrange(self.senders)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 2 * self.words)))
+        sender = self._user(sender_id) if rng.random() < self.attached else None
+        return SimpleNamespace(
+            id=msg_id, text=text, date=START_DATE + timedelta(seconds=30 * msg_id),
+            sender_id=sender_id, sender=sender, media=None, reply_to_msg_id=None, out=False,
+        )
+
+    @staticmethod
+    def _user(sender_id: int):
+        return SimpleNamespace(id=sender_id, username=f"user{sender_id}", first_name=None, title=None)
+
+    async def _round_trip(self):
+        self.requests += 1
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        else:
+            await asyncio.sleep(0)
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, min_id: int = 0,
+                            max_id: int = 0, offset_id: int = 0, reverse: bool = False,
+                            wait_time: Optional[float] = None, **kwargs):
+        low = max(min_id, offset_id if reverse else 0) + 1
+        high = min(max_id - 1 if max_id else self.n,
+                   offset_id - 1 if offset_id and not reverse else self.n)
+        ids = range(low, high + 1) if reverse else range(high, low - 1, -1)
+        if limit is not None:
+            ids = ids[:limit]
+        if not ids:
+            await self._round_trip()  # Telegram still has to answer "nothing"
+        for start in range(0, len(ids), PAGE):
+            await self._round_trip()
+            for msg_id in ids[start:start + PAGE]:
+                yield self.message(msg_id)
+
+    async def get_messages(self, entity, limit: Optional[int] = None, max_id: int = 0,
+                           ids=None, **kwargs):
+        if ids is not None:
+            await self._round_trip()
+            if isinstance(ids, list):
+                return [self.message(i) if 0 < i <= self.n else None for i in ids]
+            return self.message(ids) if 0 < ids <= self.n else None
+        messages = TotalList([m async for m in self.iter_messages(entity, limit=limit, max_id=max_id)])
+        messages.total = self.n
+        return messages
+
+    async def get_entity(self, entity):
+        await self._round_trip()
+        if isinstance(entity, list):
+            return [self._user(sender_id) for sender_id in entity]
+        return self._user(entity)
+
+    def add_event_handler(self, callback, event):
+        pass
+
+    def remove_event_handler(self, callback, event):
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeOllamaServer:
+    """Local HTTP server answering /api/generate like Ollama does when streaming.
+
+    Every response is tokens chunks of one word each, token_latency
+    seconds apart, after first_token_latency seconds plus
+    prompt_token_latency per prompt token of "prompt evaluation". Tokens
+    of a context sent back are not evaluated again. The final chunk
+    carries eval_count, eval_duration and the new context.
+    """
+
+    def __init__(self, port: int, tokens: int = 20, token_latency: float = 0.002,
+                 first_token_latency: float = 0.01, prompt_token_latency: float = 0.00002):
+        self.port = port
+        self.tokens = tokens
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self.prompt_token_latency = prompt_token_latency
+        self.requests = 0
+        self.prompt_chars = 0
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def generate(self, request):
+        data = await request.json()
+        self.requests += 1
+        self.prompt_chars += len(data['prompt'])
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        prompt_tokens = len(data['prompt']) // 4
+        await asyncio.sleep(self.first_token_latency + prompt_tokens * self.prompt_token_latency)
+        for i in range(self.tokens):
+            chunk = {'model': data['model'], 'response': WORDS[i % len(WORDS)] + " ", 'done': False}
+            await response.write(json.dumps(chunk).encode() + b"\n")
+            await asyncio.sleep(self.token_latency)
+        done = {'model': data['model'], 'response': "", 'done': True,
+                'prompt_eval_count': prompt_tokens, 'eval_count': self.tokens,
+                'eval_duration': int(self.tokens * self.token_latency * 1e9),
+                'context': data.get('context', []) + [0] * (prompt_tokens + self.tokens)}
+        await response.write(json.dumps(done).encode() + b"\n")
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class HeadlessScreen:
+    """A curses window that keeps its rows in memory and counts writes"""
+
+    def __init__(self, height: int = 50, width: int = 120):
+        self.height, self.width = height, width
+        self.rows: List[str] = [""] * height
+        self.writes = 0
+        self.keys: List[int] = []
+        self._region = (0, height - 1)
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, text, attr=0):
+        if not 0 <= y < self.height or x >= self.width:
+            raise curses.error("addstr outside the window")
+        self.writes += 1
+        row = self.rows[y].ljust(x)
+        self.rows[y] = (row[:x] + text + row[x + len(text):])[:self.width]
+
+    def getch(self):
+        return self.keys.pop(0) if self.keys else -1
+
+    def erase(self):
+        self.rows = [""] * self.height
+
+    clear = erase
+
+    def setscrreg(self, top, bottom):
+        self._region = (top, bottom)
+
+    def scroll(self, lines=1):
+        top, bottom = self._region
+        body = self.rows[top:bottom + 1]
+        if lines > 0:
+            body = body[lines:] + [""] * lines
+        else:
+            body = [""] * -lines + body[:lines]
+        self.rows[top:bottom + 1] = body
+
+    def _noop(self, *args):
+        pass
+
+    move = refresh = noutrefresh = clrtoeol = keypad = nodelay = scrollok = _noop
+    attron = attroff = _noop
+
+
+@contextmanager
+def headless_curses():
+    """Make the module-level curses calls the viewers use work without a terminal"""
+    saved = curses.curs_set, curses.doupdate
+    curses.curs_set = lambda visibility: None
+    curses.doupdate = lambda: None
+    try:
+        yield
+    finally:
+        curses.curs_set, curses.doupdate = saved
@@ -0,0 +1,241 @@
+"""Offline benchmarks for the fetch, format, render and LLM paths.
+
+Run from the repository root:
+
+    python -m benchmarks.run                      # all benchmarks, 10 to 100k messages
+    python -m benchmarks.run --sizes 1000 --only fetch render
+    python -m benchmarks.run --compare benchmarks/results/<commit>.json
+
+Results are written as JSON to benchmarks/results/<commit>.json (or
+--output), one record per benchmark and size, so runs on different
+commits can be compared with --compare.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.fakes import (
+    FakeOllamaServer, FakeTelegramClient, HeadlessScreen, fake_channel, free_port,
+    headless_curses,
+)
+
+# The modules under test read their configuration on import
+WORKDIR = tempfile.mkdtemp(prefix="tg-bench-")
+STORE_PATH = os.path.join(WORKDIR, "messages.db")
+OLLAMA_PORT = free_port()
+os.environ['MESSAGE_STORE_PATH'] = STORE_PATH
+os.environ['OLLAMA_URL'] = f"http://127.0.0.1:{OLLAMA_PORT}"
+
+from llm_client import GenerationStats, close_llm_client  # noqa: E402
+from llm_utils import TokenPrinter, add_messages_to_context, clear_global_context, process_prompt_with_context  # noqa: E402
+from message_store import close_message_store  # noqa: E402
+from message_viewer import PAGE_SIZE, MessageViewer, visible_messages  # noqa: E402
+from sender_cache import sender_cache  # noqa: E402
+from summarizer import summarize_messages  # noqa: E402
+from telegram_utils import format_message, get_last_messages  # noqa: E402
+
+BENCHMARKS = ('fetch', 'format', 'render', 'llm')
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+PROMPT = "when is the release and did the deploy work"
+FOLLOW_UP = "who asked about the tests"
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def record(results: List[Dict], name: str, size: int, seconds: float, **extra):
+    entry = {'name': name, 'size': size, 'seconds': round(seconds, 6),
+             'per_second': round(size / seconds, 1) if seconds else None}
+    entry.update(extra)
+    results.append(entry)
+    details = " ".join(f"{key}={value}" for key, value in extra.items())
+    print(f"{name:<16} {size:>7} msgs {seconds * 1000:>10.2f} ms  {details}", flush=True)
+
+
+def fresh_store():
+    close_message_store()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(STORE_PATH + suffix):
+            os.remove(STORE_PATH + suffix)
+    sender_cache.clear()
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def bench_fetch(results, size, client, entity) -> List[Dict]:
+    started = time.perf_counter()
+    messages = await get_last_messages(client, entity, size)
+    record(results, 'fetch_cold', size, time.perf_counter() - started, requests=client.requests)
+
+    client.requests = 0
+    started = time.perf_counter()
+    await get_last_messages(client, entity, size)
+    record(results, 'fetch_warm', size, time.perf_counter() - started, requests=client.requests)
+    return messages
+
+
+def bench_format(results, size, messages):
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        formatted = [format_message(msg) for msg in messages]
+        timings.append(time.perf_counter() - started)
+    record(results, 'format', size, min(timings), formatted=sum(1 for m in formatted if m))
+
+
+def bench_render(results, size, messages, entity, frames: int = 200):
+    screen = HeadlessScreen()
+    with headless_curses():
+        started = time.perf_counter()
+        viewer = MessageViewer(screen, visible_messages(messages), entity, None)
+        viewer.draw()
+        record(results, 'render_open', size, time.perf_counter() - started,
+               lines=viewer.total_lines)
+
+        timings = []
+        writes = screen.writes
+        for _ in range(frames):
+            viewer.top_line = max(0, viewer.top_line - 1)
+            started = time.perf_counter()
+            viewer.draw()
+            timings.append(time.perf_counter() - started)
+        record(results, 'render_scroll', size, sum(timings),
+               frame_ms=round(statistics.mean(timings) * 1000, 4),
+               p95_frame_ms=round(percentile(timings, 0.95) * 1000, 4),
+               writes_per_frame=round((screen.writes - writes) / frames, 1))
+
+        # Scrolling back through history: older pages are prepended one by one
+        texts = visible_messages(messages)
+        viewer = MessageViewer(screen, texts[-PAGE_SIZE:], entity, None)
+        started = time.perf_counter()
+        for end in range(len(texts) - PAGE_SIZE, 0, -PAGE_SIZE):
+            viewer.prepend_messages(texts[max(0, end - PAGE_SIZE):end])
+        record(results, 'render_history', size, time.perf_counter() - started,
+               pages=-(-len(texts) // PAGE_SIZE))
+
+
+async def bench_llm(results, size, messages, server: FakeOllamaServer):
+    requests, stats = server.requests, GenerationStats()
+    started = time.perf_counter()
+    await summarize_messages(messages, stats=stats)
+    record(results, 'llm_summarize', size, time.perf_counter() - started,
+           requests=server.requests - requests,
+           ttft_ms=round((stats.time_to_first_token or 0) * 1000, 2))
+
+    clear_global_context()
+    started = time.perf_counter()
+    await add_messages_to_context([format_message(msg) for msg in messages])
+    record(results, 'context_add', size, time.perf_counter() - started)
+
+    # The follow-up continues the session started by the first prompt
+    for name, prompt in (('llm_prompt', PROMPT), ('llm_followup', FOLLOW_UP)):
+        prompt_chars, stats = server.prompt_chars, GenerationStats()
+        started = time.perf_counter()
+        await process_prompt_with_context(prompt, TokenPrinter(out=io.StringIO()), stats)
+        record(results, name, size, time.perf_counter() - started,
+               prompt_chars=server.prompt_chars - prompt_chars,
+               ttft_ms=round((stats.time_to_first_token or 0) * 1000, 2))
+
+
+async def run_benchmarks(args) -> List[Dict]:
+    results: List[Dict] = []
+    server = FakeOllamaServer(OLLAMA_PORT, tokens=args.tokens, token_latency=args.token_latency,
+                              prompt_token_latency=args.prompt_token_latency)
+    await server.start()
+    try:
+        for size in args.sizes:
+            fresh_store()
+            client = FakeTelegramClient(size, senders=args.senders, rtt=args.rtt)
+            entity = fake_channel()
+            # Everything else runs on the fetched messages
+            messages = await bench_fetch(results, size, client, entity) \
+                if 'fetch' in args.only else await get_last_messages(client, entity, size)
+            if 'format' in args.only:
+                bench_format(results, size, messages)
+            if 'render' in args.only:
+                bench_render(results, size, messages, entity)
+            if 'llm' in args.only:
+                await bench_llm(results, size, messages, server)
+    finally:
+        await server.stop()
+        await close_llm_client()
+        close_message_store()
+    return results
+
+
+def compare(results: List[Dict], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(entry['name'], entry['size']): entry['seconds'] for entry in baseline['results']}
+    print(f"\nCompared with {baseline['commit']} (ratio > 1 is slower):")
+    for entry in results:
+        old = before.get((entry['name'], entry['size']))
+        if old:
+            ratio = entry['seconds'] / old
+            # Sub-millisecond timings are mostly noise
+            flag = "  <-- slower" if ratio > 1.2 and entry['seconds'] - old > 0.001 else ""
+            print(f"{entry['name']:<16} {entry['size']:>7} msgs {ratio:>6.2f}x{flag}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--senders', type=int, default=20, help="distinct senders per chat")
+    parser.add_argument('--rtt', type=float, default=0.0,
+                        help="simulated Telegram round trip per request, seconds")
+    parser.add_argument('--tokens', type=int, default=20, help="tokens per fake LLM response")
+    parser.add_argument('--token-latency', type=float, default=0.002,
+                        help="seconds between fake LLM tokens")
+    parser.add_argument('--prompt-token-latency', type=float, default=0.00002,
+                        help="seconds the fake LLM spends per prompt token before answering")
+    parser.add_argument('--output', help="results file, default benchmarks/results/<commit>.json")
+    parser.add_argument('--compare', help="earlier results file to compare with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    commit = git_commit()
+    try:
+        results = asyncio.run(run_benchmarks(args))
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {key: value for key, value in vars(args).items()
+                         if key not in ('output', 'compare')},
+            'results': results,
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,47 +1,148 @@
 import curses
-import asyncio
-from typing import List, Callable
+import re
+import unicodedata
+from typing import Dict, List, Tuple
 from telethon.tl.custom import Dialog
+from async_curses import curses_screen, KeyReader
+
+ESCAPE = 27
+BACKSPACE_KEYS = (curses.KEY_BACKSPACE, 127, 8)
+
+
+def normalize_name(name: str) -> str:
+    """Case- and accent-insensitive form of a chat name for matching"""
+    decomposed = unicodedata.normalize('NFKD', name or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+class NameIndex:
+    """Normalized dialog names, computed once per dialog instead of per keystroke"""
+
+    def __init__(self):
+        # dialog id -> (name as shown, normalized name, its characters)
+        self._names: Dict[int, Tuple[str, str, frozenset]] = {}
+
+    def entry(self, dialog: Dialog) -> Tuple[str, frozenset]:
+        """Normalized name and the set of its characters"""
+        entry = self._names.get(dialog.id)
+        if entry is None or entry[0] != dialog.name:  # New dialog or renamed
+            name = normalize_name(dialog.name)
+            entry = self._names[dialog.id] = (dialog.name, name, frozenset(name))
+        return entry[1:]
+
+    def update(self, dialogs: List[Dialog]):
+        """Compute the entries of new and renamed dialogs ahead of filtering"""
+        for dialog in dialogs:
+            self.entry(dialog)
+
+    def filter(self, dialogs: List[Dialog], query: str) -> List[Dialog]:
+        """Dialogs whose name contains the query's characters in order.
+
+        Exact substrings rank first, earlier and tighter matches before
+        looser ones; ties keep the order of dialogs.
+        """
+        query = normalize_name(query)
+        if not query:
+            return list(dialogs)
+        pattern = re.compile(".*?".join(map(re.escape, query)))
+        chars = frozenset(query)
+        scored: List[Tuple[tuple, int, Dialog]] = []
+        for position, dialog in enumerate(dialogs):
+            name, name_chars = self.entry(dialog)
+            start = name.find(query)
+            if start != -1:
+                scored.append(((0, start, 0), position, dialog))
+            elif chars <= name_chars:
+                # Cheap set test first: most names lack some character
+                match = pattern.search(name)
+                if match:
+                    scored.append(((1, match.end() - match.start(), match.start()), position, dialog))
+        scored.sort()
+        return [dialog for _, _, dialog in scored]
+
 
 class ChatNavigator:
     def __init__(self, stdscr, dialogs: List[Dialog]):
         self.stdscr = stdscr
-        self.dialogs = dialogs
+        self.all_dialogs = dialogs  # Live list, updated in place by DialogList
+        self.index = NameIndex()
+        self.query = ""
+        self.filtering = False
+        self.jump_buffer = ""
+        self.loading = False  # Showing the saved list while the current one loads
+        self.dialogs = list(dialogs)
         self.current_pos = 0
         self.offset = 0
+        self.selected = self.dialogs[0] if self.dialogs else None
         self.height, self.width = stdscr.getmaxyx()
         self.max_visible = self.height - 4  # Leave space for header/footer
-        
+
+    def apply_filter(self, candidates: List[Dialog] = None):
+        """Recompute the visible list, from candidates when the query only grew"""
+        self.dialogs = self.index.filter(
+            self.all_dialogs if candidates is None else candidates, self.query)
+        self.follow_selection()
+
+    def follow_selection(self):
+        """Keep the selected dialog highlighted after the list changed"""
+        # By id: a dialog from the saved snapshot is replaced by the loaded one
+        selected_id = self.selected.id if self.selected is not None else None
+        position = next((i for i, dialog in enumerate(self.dialogs) if dialog.id == selected_id), None)
+        if position is not None:
+            self.current_pos = position
+            self.selected = self.dialogs[position]
+        else:
+            self.current_pos = 0
+            self.selected = self.dialogs[0] if self.dialogs else None
+        self.scroll_to_selection()
+
+    def refresh(self):
+        """Pick up changes to the live dialog list"""
+        self.apply_filter()
+
+    def scroll_to_selection(self):
+        if self.current_pos < self.offset:
+            self.offset = self.current_pos
+        elif self.current_pos >= self.offset + self.max_visible:
+            self.offset = self.current_pos - self.max_visible + 1
+
+    def move_to(self, pos: int):
+        if not self.dialogs:
+            return
+        self.current_pos = max(0, min(pos, len(self.dialogs) - 1))
+        self.selected = self.dialogs[self.current_pos]
+        self.scroll_to_selection()
+
     def draw(self):
-        self.stdscr.clear()
-        
+        self.stdscr.erase()
+
         # Draw header
-        header = "Telegram Chats (↑/↓ to navigate, Enter to select, [ to go back, q to quit)"
-        self.stdscr.addstr(0, 0, header, curses.A_BOLD)
-        self.stdscr.addstr(1, 0, "=" * min(len(header), self.width))
-        
+        header = "Telegram Chats (↑/↓ PgUp/PgDn Home/End, / to filter, number to jump, Enter to select, [ to go back, q to quit)"
+        self.stdscr.addstr(0, 0, header[:self.width - 1], curses.A_BOLD)
+        self.stdscr.addstr(1, 0, "=" * min(len(header), self.width - 1))
+
         # Draw chats
         for i in range(min(self.max_visible, len(self.dialogs))):
             idx = i + self.offset
             if idx >= len(self.dialogs):
                 break
-                
+
             dialog = self.dialogs[idx]
             line = f"{idx + 1}. {dialog.name}"
             if dialog.unread_count > 0:
                 line += f" [{dialog.unread_count}]"
-                
+
             y = i + 2  # Start after header
             if idx == self.current_pos:
                 self.stdscr.attron(curses.A_REVERSE)
-                self.stdscr.addstr(y, 0, line[:self.width])
+                self.stdscr.addstr(y, 0, line[:self.width - 1])
                 self.stdscr.attroff(curses.A_REVERSE)
             else:
-                self.stdscr.addstr(y, 0, line[:self.width])
-        
+                self.stdscr.addstr(y, 0, line[:self.width - 1])
+
         # Draw scrollbar if needed
         if len(self.dialogs) > self.max_visible:
-            scrollbar_height = int((self.max_visible / len(self.dialogs)) * self.max_visible)
+            scrollbar_height = max(1, int((self.max_visible / len(self.dialogs)) * self.max_visible))
             scrollbar_pos = int((self.offset / len(self.dialogs)) * self.max_visible) + 2
             for i in range(self.max_visible):
                 y = i + 2
@@ -49,49 +150,110 @@ class ChatNavigator:
                     self.stdscr.addstr(y, self.width - 1, "█")
                 else:
                     self.stdscr.addstr(y, self.width - 1, "│")
-        
+
+        # Draw filter / jump line
+        if self.filtering or self.query:
+            status = f"Filter: {self.query}  ({len(self.dialogs)} of {len(self.all_dialogs)}, Esc to clear)"
+        elif self.jump_buffer:
+            status = f"Go to: {self.jump_buffer}"
+        elif self.loading:
+            status = "Updating chat list..."
+        else:
+            status = ""
+        if status:
+            self.stdscr.addstr(self.height - 1, 0, status[:self.width - 1])
+
         self.stdscr.refresh()
-    
+
+    def handle_filter_key(self, key):
+        if key == ESCAPE:
+            self.filtering = False
+            self.query = ""
+            self.apply_filter()
+        elif key in BACKSPACE_KEYS:
+            self.query = self.query[:-1]
+            self.apply_filter()
+        elif 32 <= key <= 126:
+            # Typing more can only narrow the matches down
+            self.query += chr(key)
+            self.apply_filter(self.dialogs)
+        else:
+            return False
+        return True
+
     def handle_key(self, key) -> Dialog | str | None:
-        if key == curses.KEY_UP and self.current_pos > 0:
-            self.current_pos -= 1
-            if self.current_pos < self.offset:
-                self.offset = self.current_pos
-        
-        elif key == curses.KEY_DOWN and self.current_pos < len(self.dialogs) - 1:
-            self.current_pos += 1
-            if self.current_pos >= self.offset + self.max_visible:
-                self.offset = self.current_pos - self.max_visible + 1
-        
+        if self.filtering and self.handle_filter_key(key):
+            return None
+
+        if key != ord('\n') and not ord('0') <= key <= ord('9'):
+            self.jump_buffer = ""
+
+        if key == curses.KEY_UP:
+            self.move_to(self.current_pos - 1)
+
+        elif key == curses.KEY_DOWN:
+            self.move_to(self.current_pos + 1)
+
+        elif key == curses.KEY_PPAGE:
+            self.move_to(self.current_pos - self.max_visible)
+
+        elif key == curses.KEY_NPAGE:
+            self.move_to(self.current_pos + self.max_visible)
+
+        elif key == curses.KEY_HOME:
+            self.move_to(0)
+
+        elif key == curses.KEY_END:
+            self.move_to(len(self.dialogs) - 1)
+
+        elif ord('0') <= key <= ord('9'):  # Jump to chat number
+            self.jump_buffer += chr(key)
+            self.move_to(int(self.jump_buffer) - 1)
+
         elif key == ord('\n'):  # Enter key
-            return self.dialogs[self.current_pos]
-        
+            self.jump_buffer = ""
+            return self.dialogs[self.current_pos] if self.dialogs else None
+
+        elif key == ord('/'):
+            self.filtering = True
+
+        elif key == ESCAPE and self.query:
+            self.query = ""
+            self.apply_filter()
+
         elif key == ord('['):  # [ key
             return 'back'
-        
+
         elif key == ord('q'):  # q key
             return 'quit'
-        
+
         return None
 
-async def navigate_chats(dialogs: List[Dialog]) -> Dialog | str | None:
-    def _navigate(stdscr) -> Dialog | str | None:
-        # Setup curses
+async def navigate_chats(dialog_list, on_first_frame=None) -> Dialog | str | None:
+    """Show the chat list until a chat is chosen, redrawing as dialogs update.
+
+    on_first_frame() is called once the list is first on screen.
+    """
+    with curses_screen() as stdscr, KeyReader(stdscr) as keys:
         curses.curs_set(0)  # Hide cursor
-        stdscr.nodelay(0)   # Make getch() blocking
-        
-        navigator = ChatNavigator(stdscr, dialogs)
-        result = None
-        
+        navigator = ChatNavigator(stdscr, dialog_list.dialogs)
+        version = dialog_list.version
+        indexed = None  # Version of the dialogs in navigator.index
+
         while True:
+            if dialog_list.version != version:
+                version = dialog_list.version
+                navigator.refresh()
+            navigator.loading = not dialog_list.loaded
             navigator.draw()
-            key = stdscr.getch()
-            result = navigator.handle_key(key)
-            
-            if result is not None:
-                break
-        
-        return result
-    
-    # Run the curses application
-    return curses.wrapper(_navigate)
\ No newline at end of file
+            if on_first_frame:
+                on_first_frame()
+                on_first_frame = None
+            if indexed != version:
+                # After drawing, so the first frame is not delayed
+                navigator.index.update(dialog_list.dialogs)
+                indexed = version
+            for key in await keys.read(wakeup=dialog_list.changed):
+                result = navigator.handle_key(key)
+                if result is not None:
+                    return result
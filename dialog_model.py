@@ -0,0 +1,167 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from telethon import events, types, utils
+from telethon.tl.custom import Dialog
+
+from message_store import get_message_store
+
+
+class SnapshotDialog:
+    """A dialog as saved by the last run, shown until the real one is loaded.
+
+    Has the attributes of a Telethon Dialog that the chat list and the
+    update handlers use; entity stays None until resolved.
+    """
+
+    def __init__(self, dialog_id: int, name: str, unread_count: int, pinned: bool,
+                 read_inbox_max_id: int):
+        self.id = dialog_id
+        self.name = name
+        self.unread_count = unread_count
+        self.pinned = pinned
+        self.dialog = SimpleNamespace(read_inbox_max_id=read_inbox_max_id)
+        self.entity = None
+        self.message = None
+        self.date = None
+
+
+class DialogList:
+    """The account's dialogs, loaded once and kept current from updates.
+
+    New messages move their dialog to the top (below pinned dialogs) and
+    bump its unread count; read receipts set the count to what is left.
+    `dialogs` is updated in place; after every update `version` is bumped
+    and `changed` is set, so an open chat list can redraw live.
+
+    The list is saved to the message store, so the next start can show
+    it right away with load_snapshot() while start_loading() fetches the
+    current one in the background.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.dialogs: List[Dialog] = []
+        self._by_id: Dict[int, Dialog] = {}
+        self._handlers = []
+        self.loaded = False
+        self._loading: Optional[asyncio.Task] = None
+        self.version = 0
+        self.changed = asyncio.Event()
+
+    def load_snapshot(self) -> bool:
+        """Show the dialogs saved by the last run; False if there are none"""
+        snapshot = [SnapshotDialog(*row) for row in get_message_store().load_dialogs()]
+        if not snapshot:
+            return False
+        self.dialogs[:] = snapshot
+        self._by_id = {dialog.id: dialog for dialog in snapshot}
+        self._notify()
+        return True
+
+    def save_snapshot(self):
+        get_message_store().save_dialogs([
+            (dialog.id, dialog.name, dialog.unread_count, dialog.pinned,
+             dialog.dialog.read_inbox_max_id)
+            for dialog in self.dialogs
+        ])
+
+    async def load(self):
+        """Fetch all dialogs and start following updates"""
+        dialogs = [dialog async for dialog in self.client.iter_dialogs()]
+        self.dialogs[:] = dialogs
+        self._by_id = {dialog.id: dialog for dialog in dialogs}
+        if not self._handlers:
+            self._add_handler(self._on_new_message, events.NewMessage())
+            self._add_handler(self._on_read, events.Raw(types=(
+                types.UpdateReadHistoryInbox, types.UpdateReadChannelInbox
+            )))
+        self.loaded = True
+        self._notify()
+        self.save_snapshot()
+
+    def start_loading(self):
+        """Run load() in the background"""
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self.load())
+            self._loading.add_done_callback(lambda task: self._notify())
+
+    async def wait_loaded(self):
+        if self._loading is not None:
+            await self._loading
+
+    async def resolve(self, dialog) -> Optional[Dialog]:
+        """The dialog with its entity, for one picked from the snapshot"""
+        if dialog.entity is not None:
+            return dialog
+        try:
+            # Usually instant: the session caches the entities it has seen
+            dialog.entity = await self.client.get_entity(dialog.id)
+            return dialog
+        except ValueError:
+            await self.wait_loaded()
+            return self._by_id.get(dialog.id)
+
+    def _add_handler(self, callback, event):
+        self.client.add_event_handler(callback, event)
+        self._handlers.append((callback, event))
+
+    def close(self):
+        if self._loading is not None and not self._loading.done():
+            self._loading.cancel()
+        for callback, event in self._handlers:
+            self.client.remove_event_handler(callback, event)
+        self._handlers = []
+
+    def _notify(self):
+        self.version += 1
+        self.changed.set()
+
+    def get(self, dialog_id: int) -> Optional[Dialog]:
+        return self._by_id.get(dialog_id)
+
+    def _move_to_top(self, dialog: Dialog):
+        self.dialogs.remove(dialog)
+        position = 0
+        if not dialog.pinned:
+            while position < len(self.dialogs) and self.dialogs[position].pinned:
+                position += 1
+        self.dialogs.insert(position, dialog)
+
+    async def _on_new_message(self, event):
+        dialog = self._by_id.get(event.chat_id)
+        if dialog is None:
+            await self._add_new_dialog(event.chat_id)
+            return
+        dialog.message = event.message
+        dialog.date = event.message.date
+        if not event.out:
+            dialog.unread_count += 1
+        self._move_to_top(dialog)
+        self._notify()
+
+    async def _add_new_dialog(self, dialog_id: int):
+        # A chat we had no dialog for just got a message, so it is now
+        # among the most recent dialogs
+        async for dialog in self.client.iter_dialogs(limit=10):
+            if dialog.id == dialog_id and dialog_id not in self._by_id:
+                self._by_id[dialog_id] = dialog
+                self.dialogs.append(dialog)
+                self._move_to_top(dialog)
+                self._notify()
+                return
+
+    async def _on_read(self, update):
+        if isinstance(update, types.UpdateReadHistoryInbox):
+            peer = update.peer
+        else:
+            peer = types.PeerChannel(update.channel_id)
+        dialog = self._by_id.get(utils.get_peer_id(peer))
+        if dialog is None:
+            return
+        # Where the unread range starts, see digest.fetch_unread
+        dialog.dialog.read_inbox_max_id = max(dialog.dialog.read_inbox_max_id, update.max_id)
+        if dialog.unread_count != update.still_unread_count:
+            dialog.unread_count = update.still_unread_count
+            self._notify()
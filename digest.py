@@ -0,0 +1,81 @@
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telethon.tl.custom import Dialog
+
+from llm_client import GenerationStats
+from llm_utils import digest_prompt, stream_llm_response
+from message_store import get_message_store
+from summarizer import LLM_PARALLELISM, summarize_messages
+
+# Dialogs fetched from Telegram at the same time
+TELEGRAM_PARALLELISM = int(os.getenv('TELEGRAM_PARALLELISM', '4'))
+# Most unread messages summarized per chat, the newest ones are kept
+DIGEST_MAX_MESSAGES = int(os.getenv('DIGEST_MAX_MESSAGES', '500'))
+
+ChatCallback = Callable[[Dialog, int, str], None]
+
+
+def unread_dialogs(dialogs: List[Dialog]) -> List[Dialog]:
+    return [dialog for dialog in dialogs if dialog.unread_count > 0]
+
+
+async def fetch_unread(client, dialog: Dialog, semaphore: asyncio.Semaphore) -> List[Dict]:
+    """The messages after the dialog's read marker, at most DIGEST_MAX_MESSAGES"""
+    limit = min(dialog.unread_count, DIGEST_MAX_MESSAGES)
+    async with semaphore:
+        messages = await get_message_store().get_last(client, dialog.entity, limit)
+    read_max_id = dialog.dialog.read_inbox_max_id
+    return [msg for msg in messages if msg['id'] > read_max_id]
+
+
+async def summarize_unread(client, dialog: Dialog, telegram: asyncio.Semaphore,
+                           llm: asyncio.Semaphore) -> Tuple[int, str]:
+    """(number of unread messages, summary) for one dialog"""
+    try:
+        messages = await fetch_unread(client, dialog, telegram)
+    except Exception as e:
+        return 0, f"Error fetching messages: {str(e)}"
+    if not messages:
+        return 0, "No unread messages."
+    try:
+        return len(messages), await summarize_messages(messages, semaphore=llm)
+    except Exception as e:
+        return len(messages), f"Error creating summary: {str(e)}"
+
+
+async def build_digest(client, dialogs: List[Dialog],
+                       on_chat: Optional[ChatCallback] = None,
+                       on_chunk: Optional[Callable[[str], None]] = None,
+                       stats: Optional[GenerationStats] = None,
+                       fetch_parallelism: int = TELEGRAM_PARALLELISM,
+                       llm_parallelism: int = LLM_PARALLELISM) -> str:
+    """Summarize the unread messages of dialogs concurrently and combine them.
+
+    Fetches and LLM requests are limited separately, so chats keep
+    downloading while others are being summarized. on_chat(dialog, count,
+    summary) is called as each chat's summary completes; the combined
+    digest is streamed to on_chunk.
+    """
+    telegram = asyncio.Semaphore(max(1, fetch_parallelism))
+    llm = asyncio.Semaphore(max(1, llm_parallelism))
+
+    async def summarize(index: int, dialog: Dialog):
+        return index, await summarize_unread(client, dialog, telegram, llm)
+
+    sections = [""] * len(dialogs)
+    tasks = [asyncio.ensure_future(summarize(i, dialog)) for i, dialog in enumerate(dialogs)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            index, (count, summary) = await next_result
+            sections[index] = f"{dialogs[index].name} ({count} unread):\n{summary.strip()}"
+            if on_chat:
+                on_chat(dialogs[index], count, summary)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # In dialog order, most recently active chat first
+    async with llm:
+        return await stream_llm_response(digest_prompt("\n\n".join(sections)), on_chunk, stats)
@@ -0,0 +1,215 @@
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from telethon import errors
+
+from message_store import get_chat_id
+from sender_cache import resolve_sender_names
+
+pa = pq = None  # pyarrow modules, imported on the first Parquet export
+
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+EXPORT_FORMATS = ('jsonl', 'parquet')
+# Messages resolved and written together; also how often the checkpoint moves
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', '1000'))
+# Rows per Parquet part file, each written in one go
+PARQUET_PART_ROWS = int(os.getenv('PARQUET_PART_ROWS', '50000'))
+# Seconds Telethon sleeps between history requests outside a takeout session
+EXPORT_WAIT_TIME = float(os.getenv('EXPORT_WAIT_TIME', '1'))
+
+ProgressCallback = Callable[[int, float], None]
+
+
+def message_row(chat_id: int, msg, sender_names: Dict[int, str]) -> Dict:
+    return {
+        'chat_id': chat_id,
+        'id': msg.id,
+        'date': msg.date,
+        'sender_id': msg.sender_id,
+        'sender': sender_names.get(msg.sender_id),
+        'text': msg.text or '',
+        'reply_to': msg.reply_to_msg_id,
+        'media': type(msg.media).__name__ if msg.media else None,
+    }
+
+
+def _write_json(path: str, data: Dict):
+    """Replace path atomically, so a crash never leaves half a file"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class JsonlWriter:
+    """Appends rows to one JSON Lines file.
+
+    The checkpoint records the file size after the last complete batch;
+    rows written after it are cut off again when an export resumes.
+    """
+
+    def __init__(self, base: str, checkpoint: Dict):
+        self.path = base + '.jsonl'
+        self.file = open(self.path, 'ab')
+        self.file.truncate(checkpoint.get('offset', 0))
+        self.file.seek(0, os.SEEK_END)
+
+    def write(self, rows: List[Dict]):
+        for row in rows:
+            row = dict(row, date=row['date'].isoformat())
+            self.file.write(json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def commit(self, checkpoint: Dict, last_id: int, exported: int) -> bool:
+        """Make the rows written so far durable; True if checkpoint moved"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        checkpoint.update(last_id=last_id, exported=exported, offset=self.file.tell())
+        return True
+
+    def close(self, checkpoint: Dict):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes rows to numbered Parquet part files in a directory.
+
+    Rows are held until a part is full and the checkpoint only moves once
+    they are in a part file, so memory is bounded by the part size.
+    """
+
+    def __init__(self, base: str, checkpoint: Dict):
+        # Optional, and slow to import, so only loaded for Parquet exports
+        global pa, pq
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        self.schema = pa.schema([
+            ('chat_id', pa.int64()), ('id', pa.int64()),
+            ('date', pa.timestamp('s', tz='UTC')), ('sender_id', pa.int64()),
+            ('sender', pa.string()), ('text', pa.string()),
+            ('reply_to', pa.int64()), ('media', pa.string()),
+        ])
+        self.path = base
+        os.makedirs(self.path, exist_ok=True)
+        self.rows: List[Dict] = []
+        self.pending = None  # (last_id, exported) of the buffered rows
+
+    def write(self, rows: List[Dict]):
+        self.rows.extend(rows)
+
+    def _write_part(self, checkpoint: Dict):
+        part = checkpoint.get('parts', 0)
+        path = os.path.join(self.path, f"part-{part:05d}.parquet")
+        pq.write_table(pa.Table.from_pylist(self.rows, schema=self.schema), path + '.tmp')
+        os.replace(path + '.tmp', path)
+        last_id, exported = self.pending
+        checkpoint.update(last_id=last_id, exported=exported, parts=part + 1)
+        self.rows = []
+
+    def commit(self, checkpoint: Dict, last_id: int, exported: int) -> bool:
+        """Write a part once enough rows are buffered; True if checkpoint moved"""
+        self.pending = (last_id, exported)
+        if len(self.rows) < PARQUET_PART_ROWS:
+            return False
+        self._write_part(checkpoint)
+        return True
+
+    def close(self, checkpoint: Dict):
+        if self.rows and self.pending:
+            self._write_part(checkpoint)
+
+
+WRITERS = {'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+async def _export(client, entity, base: str, fmt: str, wait_time: Optional[float],
+                  on_progress: Optional[ProgressCallback]) -> Dict:
+    chat_id = get_chat_id(entity)
+    checkpoint_path = f"{base}.{fmt}.checkpoint.json"
+    checkpoint = {'chat_id': chat_id, 'last_id': 0, 'exported': 0}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint.update(json.load(f))
+    resumed_from, resumed_count = checkpoint['last_id'], checkpoint['exported']
+    writer = WRITERS[fmt](base, checkpoint)
+
+    started = time.monotonic()
+    count = 0
+    batch = []
+
+    async def flush():
+        nonlocal batch
+        sender_names = await resolve_sender_names(client, batch)
+        writer.write([message_row(chat_id, msg, sender_names) for msg in batch])
+        if writer.commit(checkpoint, batch[-1].id, resumed_count + count):
+            _write_json(checkpoint_path, checkpoint)
+        batch = []
+        if on_progress:
+            on_progress(count, time.monotonic() - started)
+
+    try:
+        # Oldest first, so everything up to the checkpoint is known to be done
+        async for msg in client.iter_messages(entity, reverse=True, min_id=checkpoint['last_id'],
+                                              wait_time=wait_time):
+            batch.append(msg)
+            count += 1
+            if len(batch) >= EXPORT_BATCH:
+                await flush()
+        if batch:
+            await flush()
+    finally:
+        writer.close(checkpoint)
+        _write_json(checkpoint_path, checkpoint)
+
+    return {
+        'path': writer.path,
+        'new': count,
+        'total': checkpoint['exported'],
+        'resumed_from': resumed_from,
+        'seconds': time.monotonic() - started,
+    }
+
+
+async def export_chat(client, entity, fmt: str = 'jsonl', out_dir: str = EXPORT_DIR,
+                      use_takeout: bool = True,
+                      on_progress: Optional[ProgressCallback] = None) -> Dict:
+    """Stream a chat's full history to out_dir, oldest message first.
+
+    Messages are fetched, written and checkpointed in batches, so memory
+    use does not grow with the chat. Running the export again resumes
+    after the last checkpoint, which also picks up messages sent since.
+    A takeout session is used for its higher rate limits when Telegram
+    allows one right away; otherwise history is paged with wait_time.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {EXPORT_FORMATS}")
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, str(get_chat_id(entity)))
+
+    if use_takeout:
+        try:
+            async with client.takeout(finalize=True, contacts=False, users=True, chats=True,
+                                      megagroups=True, channels=True) as takeout:
+                result = await _export(takeout, entity, base, fmt, 0, on_progress)
+                result['takeout'] = True
+                return result
+        except errors.TakeoutInitDelayError as e:
+            print(f"Takeout not available for another {e.seconds}s, exporting without it.")
+    result = await _export(client, entity, base, fmt, EXPORT_WAIT_TIME, on_progress)
+    result['takeout'] = False
+    return result
+
+
+def format_export_result(result: Dict) -> str:
+    rate = result['new'] / result['seconds'] if result['seconds'] else 0
+    text = (f"Exported {result['new']} messages to {result['path']} "
+            f"in {result['seconds']:.1f}s ({rate:.0f} msgs/s)")
+    if result['resumed_from']:
+        text += f", resumed after message {result['resumed_from']}"
+    return text + f". {result['total']} messages exported in total."
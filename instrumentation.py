@@ -0,0 +1,164 @@
+import atexit
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+# Set STATS_ENABLED=0 to turn all recording into no-ops
+STATS_ENABLED = os.getenv('STATS_ENABLED', '1') != '0'
+# When set, every observation is also appended to this JSON Lines file
+STATS_FILE = os.getenv('STATS_FILE')
+
+
+class Histogram:
+    """Distribution of non-negative values in power-of-two buckets.
+
+    Values are bucketed by the bit length of their value in micro-units,
+    so recording is a few integer operations and memory stays constant;
+    percentiles are accurate to within a factor of two.
+    """
+
+    def __init__(self):
+        self.buckets: List[int] = []
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, value: float):
+        bucket = int(value * 1e6).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th value, capped at max"""
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(self.max, (1 << bucket) / 1e6)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ('stats', 'name', 'started')
+
+    def __init__(self, stats: 'Stats', name: str):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_TIMER = _NoTimer()
+
+
+class Stats:
+    """Counters and histograms for the hot paths, shown by /stats.
+
+    Names ending in .seconds are latencies, the rest are plain values or
+    counts. When disabled, every method returns right away and timer()
+    hands out a shared no-op context manager.
+    """
+
+    def __init__(self, enabled: bool = STATS_ENABLED, path: Optional[str] = STATS_FILE):
+        self.enabled = enabled
+        self.path = path
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.started = time.time()
+        self._file = None
+
+    def count(self, name: str, n: float = 1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.path:
+            self._write('count', name, n)
+
+    def observe(self, name: str, value: float):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(value)
+        if self.path:
+            self._write('observe', name, value)
+
+    def timer(self, name: str):
+        """Context manager recording the time spent inside it under name"""
+        if not self.enabled:
+            return NO_TIMER
+        return _Timer(self, name)
+
+    def _write(self, kind: str, name: str, value: float):
+        if self._file is None:
+            self._file = open(self.path, 'a', buffering=64 * 1024)
+            atexit.register(self.close)
+        self._file.write(json.dumps({'t': round(time.time(), 6), 'kind': kind,
+                                     'name': name, 'value': value}) + "\n")
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+        self.started = time.time()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def report(self) -> str:
+        if not self.enabled:
+            return "Stats are disabled (STATS_ENABLED=0)."
+        if not self.counters and not self.histograms:
+            return "No stats recorded yet."
+        lines = [f"Stats for the last {time.time() - self.started:.0f}s"]
+        latencies = {name[:-len('.seconds')]: h for name, h in self.histograms.items()
+                     if name.endswith('.seconds')}
+        values = {name: h for name, h in self.histograms.items() if not name.endswith('.seconds')}
+        if latencies:
+            lines.append(f"\n{'Latency (ms)':<32}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}")
+            for name, h in sorted(latencies.items()):
+                lines.append(f"{name:<32}{h.count:>8}{h.mean * 1000:>10.1f}"
+                             f"{h.percentile(0.5) * 1000:>10.1f}{h.percentile(0.95) * 1000:>10.1f}"
+                             f"{h.max * 1000:>10.1f}")
+        if values:
+            lines.append(f"\n{'Values':<32}{'count':>8}{'mean':>10}{'min':>10}{'max':>10}")
+            for name, h in sorted(values.items()):
+                lines.append(f"{name:<32}{h.count:>8}{h.mean:>10.1f}{h.min:>10.1f}{h.max:>10.1f}")
+        if self.counters:
+            lines.append(f"\n{'Counters':<32}{'total':>8}")
+            for name, total in sorted(self.counters.items()):
+                lines.append(f"{name:<32}{total:>8g}")
+        return "\n".join(lines)
+
+
+stats = Stats()
@@ -0,0 +1,236 @@
+import asyncio
+import codecs
+import os
+import sys
+import termios
+import tty
+from typing import List, Optional, Sequence
+
+HISTORY_SIZE = 500  # Lines remembered per editor
+
+# Final bytes of the escape sequences understood, with their ~ parameters
+ESCAPE_KEYS = {'A': 'up', 'B': 'down', 'C': 'right', 'D': 'left', 'H': 'home', 'F': 'end'}
+TILDE_KEYS = {'1': 'home', '7': 'home', '4': 'end', '8': 'end', '3': 'delete'}
+# Emacs-style Ctrl keys, Ctrl-D and Tab are handled separately
+CONTROL_KEYS = {'\x01': 'home', '\x05': 'end', '\x02': 'left', '\x06': 'right',
+                '\x15': 'kill_start', '\x0b': 'kill_end', '\x17': 'kill_word',
+                '\x10': 'up', '\x0e': 'down'}
+
+
+class LineEditor:
+    """Reads lines from the terminal without blocking the event loop.
+
+    Like KeyReader in async_curses, stdin is watched with loop.add_reader,
+    so Telegram updates and background tasks keep running while a prompt
+    waits. On a terminal, keys are handled one by one in cbreak mode:
+    cursor movement, Ctrl-A/E/U/K/W, up and down through the history and
+    tab completion of the words given as completions. Otherwise lines are
+    read as they are, e.g. from a pipe. Input read past the end of a line
+    is kept for the next read_line, so all prompts on one stdin should
+    share an editor, see get_line_editor.
+    """
+
+    def __init__(self, completions: Sequence[str] = (), history_size: int = HISTORY_SIZE,
+                 fd: Optional[int] = None, out=None):
+        self.completions = sorted(completions)
+        self.history: List[str] = []
+        self.history_size = history_size
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self.out = out or sys.stdout
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._typed_ahead = ""  # Typed after the last line was entered
+        self._plain_buffer = b""
+        self._pollable = True
+        self._command = True
+
+    async def read_line(self, prompt: str = "", command: bool = True) -> str:
+        """Show prompt and return the line entered, without the newline.
+
+        Lines read with command False, such as answers to a question, are
+        not completed and not added to the history. Raises EOFError when
+        stdin ends, or on Ctrl-D at an empty line.
+        """
+        self._command = command
+        head, _, prompt = prompt.rpartition("\n")
+        if head:
+            self.out.write(head + "\n")
+        if not os.isatty(self.fd):
+            return await self._read_plain(prompt)
+
+        self.prompt, self.line, self.cursor = prompt, "", 0
+        self._position, self._draft, self._escape = len(self.history), "", None
+        loop = asyncio.get_running_loop()
+        self._done = loop.create_future()
+        saved = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)  # Keys arrive one by one and are not echoed
+        try:
+            self._render()
+            pending, self._typed_ahead = self._typed_ahead, ""
+            self._feed(pending)
+            if not self._done.done():
+                loop.add_reader(self.fd, self._on_readable)
+                try:
+                    await self._done
+                finally:
+                    loop.remove_reader(self.fd)
+        finally:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, saved)
+        line = self._done.result()
+        if command and line and (not self.history or self.history[-1] != line):
+            self.history.append(line)
+            del self.history[:-self.history_size]
+        return line
+
+    async def _read_plain(self, prompt: str) -> str:
+        self.out.write(prompt)
+        self.out.flush()
+        loop = asyncio.get_running_loop()
+        while b"\n" not in self._plain_buffer:
+            if self._pollable:
+                readable = loop.create_future()
+                try:
+                    loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+                except PermissionError:
+                    # Regular files and /dev/null cannot be watched, but never block either
+                    self._pollable = False
+                else:
+                    try:
+                        await readable
+                    finally:
+                        loop.remove_reader(self.fd)
+            data = os.read(self.fd, 4096)
+            if not data:
+                line, self._plain_buffer = self._plain_buffer, b""
+                if not line:
+                    raise EOFError
+                return line.decode('utf-8', errors='replace')
+            self._plain_buffer += data
+        line, _, self._plain_buffer = self._plain_buffer.partition(b"\n")
+        return line.decode('utf-8', errors='replace').rstrip("\r")
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 1024)
+        except BlockingIOError:
+            return
+        if not data:
+            self._finish(error=EOFError())
+            return
+        self._feed(self._decoder.decode(data))
+
+    def _finish(self, line: str = "", error: Optional[BaseException] = None):
+        self.out.write("\n")
+        self.out.flush()
+        if error is not None:
+            self._done.set_exception(error)
+        else:
+            self._done.set_result(line)
+
+    def _feed(self, text: str):
+        for i, char in enumerate(text):
+            if self._done.done():
+                self._typed_ahead += text[i:]
+                return
+            self._key(char)
+        if not self._done.done():
+            self._render()
+
+    def _key(self, char: str):
+        if self._escape is not None:
+            self._escape += char
+            if len(self._escape) == 1 and char not in '[O':
+                self._escape = None  # Alt+key, ignored
+            elif len(self._escape) > 1 and '@' <= char <= '~':
+                sequence, self._escape = self._escape, None
+                params = sequence[1:-1]
+                self._action(TILDE_KEYS.get(params) if char == '~' else ESCAPE_KEYS.get(char))
+            return
+        if char == '\x1b':
+            self._escape = ""
+        elif char in '\r\n':
+            self._finish(self.line)
+        elif char in '\x7f\x08':
+            self._action('backspace')
+        elif char == '\x04':
+            if self.line:
+                self._action('delete')
+            else:
+                self._finish(error=EOFError())
+        elif char == '\t':
+            self._complete()
+        elif char in CONTROL_KEYS:
+            self._action(CONTROL_KEYS[char])
+        elif char >= ' ':
+            self.line = self.line[:self.cursor] + char + self.line[self.cursor:]
+            self.cursor += 1
+
+    def _action(self, action: Optional[str]):
+        line, cursor = self.line, self.cursor
+        if action == 'left':
+            self.cursor = max(0, cursor - 1)
+        elif action == 'right':
+            self.cursor = min(len(line), cursor + 1)
+        elif action == 'home':
+            self.cursor = 0
+        elif action == 'end':
+            self.cursor = len(line)
+        elif action == 'backspace' and cursor:
+            self.line, self.cursor = line[:cursor - 1] + line[cursor:], cursor - 1
+        elif action == 'delete':
+            self.line = line[:cursor] + line[cursor + 1:]
+        elif action == 'kill_start':
+            self.line, self.cursor = line[cursor:], 0
+        elif action == 'kill_end':
+            self.line = line[:cursor]
+        elif action == 'kill_word':
+            start = len(line[:cursor].rstrip().rpartition(' ')[0])
+            start += 1 if start else 0
+            self.line, self.cursor = line[:start] + line[cursor:], start
+        elif action == 'up' and self._position > 0:
+            if self._position == len(self.history):
+                self._draft = line
+            self._position -= 1
+            self.line = self.history[self._position]
+            self.cursor = len(self.line)
+        elif action == 'down' and self._position < len(self.history):
+            self._position += 1
+            self.line = (self.history[self._position] if self._position < len(self.history)
+                         else self._draft)
+            self.cursor = len(self.line)
+
+    def _complete(self):
+        """Complete the first word: uniquely, to the longest common prefix,
+        or else list the candidates"""
+        word = self.line[:self.cursor]
+        if ' ' in word or not self.completions or not self._command:
+            return
+        matches = [completion for completion in self.completions if completion.startswith(word)]
+        if len(matches) == 1:
+            insert = matches[0][len(word):] + " "
+        else:
+            insert = os.path.commonprefix(matches)[len(word):] if matches else ""
+            if matches and not insert:
+                self.out.write("\n" + "  ".join(matches) + "\n")
+        self.line = self.line[:self.cursor] + insert + self.line[self.cursor:]
+        self.cursor += len(insert)
+
+    def _render(self):
+        back = len(self.line) - self.cursor
+        self.out.write(f"\r{self.prompt}{self.line}\x1b[K" + (f"\x1b[{back}D" if back else ""))
+        self.out.flush()
+
+
+_editor: Optional[LineEditor] = None
+
+
+def get_line_editor() -> LineEditor:
+    """The editor shared by every prompt on stdin"""
+    global _editor
+    if _editor is None:
+        _editor = LineEditor()
+    return _editor
+
+
+async def ainput(prompt: str = "") -> str:
+    """input() for coroutines, reading through the shared editor"""
+    return await get_line_editor().read_line(prompt, command=False)
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+
+from instrumentation import stats as metrics
+
+OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+LLM_MODEL = os.getenv('LLM_MODEL', 'llama2')
+
+# Generation can legitimately take minutes, so only bound the connection
+# setup and the gap between two streamed chunks, not the whole request.
+CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', '120'))
+
+# Errors that mean the model could not be reached or timed out
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class LLMError(Exception):
+    """Raised when the LLM API reports an error or returns garbage"""
+
+
+class GenerationStats:
+    """Timing of one streamed generation.
+
+    Time to first token is measured from when the stats were created, so
+    it covers everything the user waited for, not just the last request.
+    Tokens per second come from Ollama's own eval counters.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_token: Optional[float] = None
+        self.eval_count = 0
+        self.eval_duration = 0  # Nanoseconds
+
+    def observe(self, chunk: Dict):
+        if self.first_token is None and chunk.get('response'):
+            self.first_token = time.monotonic()
+        if chunk.get('done'):
+            self.eval_count = chunk.get('eval_count', 0)
+            self.eval_duration = chunk.get('eval_duration', 0)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.first_token is None:
+            return None
+        return self.first_token - self.started
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if not self.eval_duration:
+            return None
+        return self.eval_count / (self.eval_duration / 1e9)
+
+    def __str__(self):
+        parts = []
+        if self.time_to_first_token is not None:
+            parts.append(f"first token after {self.time_to_first_token:.2f}s")
+        if self.tokens_per_second is not None:
+            parts.append(f"{self.eval_count} tokens at {self.tokens_per_second:.1f} tokens/s")
+        return ", ".join(parts) or "no tokens received"
+
+
+def _record_generation(chunk: Dict, seconds: float):
+    metrics.observe('llm.generate.seconds', seconds)
+    metrics.observe('llm.prompt_tokens', chunk.get('prompt_eval_count', 0))
+    metrics.observe('llm.response_tokens', chunk.get('eval_count', 0))
+    if chunk.get('eval_duration'):
+        metrics.observe('llm.tokens_per_second', chunk.get('eval_count', 0) / (chunk['eval_duration'] / 1e9))
+
+
+class LLMClient:
+    """Async Ollama client sharing one keep-alive connection pool"""
+
+    def __init__(self, base_url: str = OLLAMA_URL, model: str = LLM_MODEL,
+                 pool_size: int = 8):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(
+                total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def stream_generate(self, prompt: str, stats: Optional[GenerationStats] = None,
+                              **options) -> AsyncIterator[Dict]:
+        """Yield the decoded NDJSON chunks of a streaming /api/generate call.
+
+        Chunks are passed to stats, when given, as they arrive. Cancelling
+        the consuming task closes the response, which makes Ollama stop
+        generating.
+        """
+        data = {"model": self.model, "prompt": prompt, "stream": True}
+        data.update(options)
+        session = self._get_session()
+        metrics.count('llm.requests')
+        started = time.perf_counter()
+        first_token = True
+        async with session.post(f"{self.base_url}/api/generate", json=data) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line.decode('utf-8'))
+                except json.JSONDecodeError as e:
+                    raise LLMError(f"Could not decode response: {str(e)}")
+                if 'error' in chunk:
+                    raise LLMError(chunk['error'])
+                if stats is not None:
+                    stats.observe(chunk)
+                if first_token and chunk.get('response'):
+                    metrics.observe('llm.first_token.seconds', time.perf_counter() - started)
+                    first_token = False
+                if chunk.get('done'):
+                    _record_generation(chunk, time.perf_counter() - started)
+                yield chunk
+                if chunk.get('done'):
+                    break
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_client: Optional[LLMClient] = None
+
+
+def get_llm_client() -> LLMClient:
+    """Return the process-wide LLM client"""
+    global _client
+    if _client is None:
+        _client = LLMClient()
+    return _client
+
+
+async def close_llm_client():
+    """Close the pooled session, if one was ever opened"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,165 @@
+import bisect
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from retrieval import HashedTfidfIndex
+
+# Token budget for all messages held in the context. Prompts only carry
+# the relevant part of it, see MessageContext.select_relevant
+CONTEXT_TOKENS = int(os.getenv('LLM_CONTEXT_TOKENS', '200000'))
+# 'oldest' drops the oldest messages overall, 'per_chat' gives every chat
+# an equal share of the budget and trims the chats that exceed it
+CONTEXT_EVICTION = os.getenv('LLM_CONTEXT_EVICTION', 'oldest')
+EVICTION_POLICIES = ('oldest', 'per_chat')
+# Messages sent with a /prompt: the most relevant ones plus the latest few
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '40'))
+RETRIEVAL_RECENT = int(os.getenv('RETRIEVAL_RECENT', '10'))
+
+MessageKey = Tuple[int, int]  # (chat id, message id)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting, about four characters per token"""
+    return len(text) // 4 + 1
+
+
+def render_message(msg: Dict) -> str:
+    return f"[{msg['date']}] {msg['sender']}: {msg['text']}"
+
+
+class MessageContext:
+    """Messages collected with /add, deduplicated and kept under a token budget.
+
+    Messages are kept in chronological order together with their rendered
+    lines, overall and per chat, so eviction finds its victims without
+    scanning. A TF-IDF index over the messages lets prompts carry only the
+    messages relevant to them.
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKENS, policy: str = CONTEXT_EVICTION):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {policy!r}, expected one of {EVICTION_POLICIES}")
+        self.budget = budget
+        self.policy = policy
+        self._messages: Dict[MessageKey, Dict] = {}
+        self._lines: Dict[MessageKey, str] = {}
+        self._tokens: Dict[MessageKey, int] = {}
+        self._chat_tokens: Dict[int, int] = {}
+        self._order: List[tuple] = []  # Sorted (date, chat id, message id)
+        self._chat_order: Dict[int, List[tuple]] = {}  # The same, split by chat
+        self._rendered = ""
+        self._rendered_version = 0
+        self.index = HashedTfidfIndex()
+        self.tokens = 0
+        self.version = 0  # Bumped on every change
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        for _, chat_id, msg_id in self._order:
+            yield self._messages[(chat_id, msg_id)]
+
+    def __contains__(self, key: MessageKey):
+        return key in self._messages
+
+    @property
+    def chats(self) -> int:
+        return len(self._chat_tokens)
+
+    def add(self, messages: Iterable[Optional[Dict]]) -> Tuple[int, int, int]:
+        """Add messages, skipping ones already present; returns (added, duplicates, evicted)"""
+        added = duplicates = 0
+        for msg in messages:
+            if not msg:
+                continue
+            key = (msg['chat_id'], msg['id'])
+            if key in self._messages:
+                duplicates += 1
+                continue
+            self._insert(key, msg)
+            added += 1
+        evicted = self._evict()
+        if added or evicted:
+            self.version += 1
+        return added, duplicates, evicted
+
+    def _insert(self, key: MessageKey, msg: Dict):
+        line = render_message(msg)
+        tokens = estimate_tokens(line)
+        self._messages[key] = msg
+        self._lines[key] = line
+        self._tokens[key] = tokens
+        self.tokens += tokens
+        self._chat_tokens[key[0]] = self._chat_tokens.get(key[0], 0) + tokens
+        self.index.add(key, f"{msg['sender']} {msg['text']}")
+
+        sort_key = (msg['date'], key[0], key[1])
+        bisect.insort(self._order, sort_key)
+        bisect.insort(self._chat_order.setdefault(key[0], []), sort_key)
+
+    def _remove(self, position: int):
+        sort_key = self._order.pop(position)
+        _, chat_id, msg_id = sort_key
+        key = (chat_id, msg_id)
+        chat_order = self._chat_order[chat_id]
+        del chat_order[bisect.bisect_left(chat_order, sort_key)]
+        if not chat_order:
+            del self._chat_order[chat_id]
+        del self._lines[key]
+        tokens = self._tokens.pop(key)
+        del self._messages[key]
+        self.index.remove(key)
+        self.tokens -= tokens
+        self._chat_tokens[chat_id] -= tokens
+        if not self._chat_tokens[chat_id]:
+            del self._chat_tokens[chat_id]
+
+    def _evict(self) -> int:
+        evicted = 0
+        while self.tokens > self.budget and self._order:
+            if self.policy == 'per_chat':
+                quota = self.budget / self.chats
+                chat_id = max(self._chat_tokens, key=self._chat_tokens.get)
+                if self._chat_tokens[chat_id] <= quota:
+                    # Every chat is within its share, fall back to the oldest message
+                    position = 0
+                else:
+                    # The chat's oldest message, found without scanning the other chats
+                    position = bisect.bisect_left(self._order, self._chat_order[chat_id][0])
+            else:
+                position = 0
+            self._remove(position)
+            evicted += 1
+        return evicted
+
+    def render(self) -> str:
+        """The context as text, one line per message, rebuilt only after changes"""
+        if self._rendered_version != self.version:
+            self._rendered = "".join(
+                self._lines[(chat_id, msg_id)] + "\n" for _, chat_id, msg_id in self._order
+            )
+            self._rendered_version = self.version
+        return self._rendered
+
+    def select_relevant(self, query: str, top_k: int = RETRIEVAL_TOP_K,
+                        recent: int = RETRIEVAL_RECENT) -> List[MessageKey]:
+        """Keys of the top_k messages most similar to query plus the latest
+        recent messages, in chronological order"""
+        if len(self._order) <= top_k + recent:
+            return [(chat_id, msg_id) for _, chat_id, msg_id in self._order]
+        keys = {key for key, _ in self.index.search(query, top_k)}
+        keys.update((chat_id, msg_id) for _, chat_id, msg_id in self._order[-recent:] if recent)
+        return sorted(keys, key=lambda key: (self._messages[key]['date'],) + key)
+
+    def render_keys(self, keys: Iterable[MessageKey]) -> str:
+        """Prompt text for the given messages, in the order given"""
+        return "".join(self._lines[key] + "\n" for key in keys)
+
+    def clear(self) -> int:
+        """Drop all messages and return how many there were"""
+        count = len(self._order)
+        version = self.version
+        self.__init__(self.budget, self.policy)
+        self.version = version + 1
+        return count
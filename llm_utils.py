@@ -1,121 +1,248 @@
-import requests
-from typing import List, Dict
-import sys
 import time
-import json
+from contextvars import ContextVar
+from typing import Callable, List, Dict, Optional, Set, TextIO, Tuple
+import sys
+from llm_client import get_llm_client, GenerationStats, LLMError, NETWORK_ERRORS
+from llm_context import MessageContext, MessageKey
+
+global_context = MessageContext()
+
+# Streamed text is written to the terminal at most this often (seconds)
+STREAM_FLUSH_INTERVAL = 0.05
+
+
+class TokenPrinter:
+    """Buffered terminal output for a streamed LLM response.
+
+    Chunks are collected and written out together at most every
+    flush_interval seconds, except the first one, which is shown at once.
+    The header is only printed once there is something to show under it.
+    """
+
+    def __init__(self, header: str = "", out: Optional[TextIO] = None,
+                 flush_interval: float = STREAM_FLUSH_INTERVAL):
+        self.header = header
+        self.out = out or sys.stdout
+        self.flush_interval = flush_interval
+        self.written = False
+        self._pending: List[str] = []
+        self._last_flush = 0.0
 
-global_context: List[Dict] = []
+    def write(self, text: str):
+        if not text:
+            return
+        if not self.written:
+            self._pending.append(self.header)
+            self.written = True
+        self._pending.append(text)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self.out.write("".join(self._pending))
+            self._pending = []
+        self.out.flush()
+        self._last_flush = time.monotonic()
+
+    def finish(self):
+        """Flush what is left and end the line"""
+        if self.written:
+            self._pending.append("\n")
+        self.flush()
 
 def show_global_context() -> str:
-    """Display the current global context"""
-    if not global_context:
+    """Display the current context"""
+    context = current_context()
+    if not context:
         return "Context is empty"
     
     context_text = "\nCurrent context:"
-    context_text += f"\nTotal messages: {len(global_context)}\n"
+    context_text += f"\nTotal messages: {len(context)} from {context.chats} chat(s)"
+    context_text += f"\nTokens: ~{context.tokens} of {context.budget} ({context.policy} eviction)\n"
     context_text += "-" * 40 + "\n"
-    
-    for msg in global_context:
-        context_text += f"[{msg['date']}] {msg['sender']}: {msg['text']}\n"
-    
+    context_text += context.render()
     context_text += "-" * 40
     return context_text
 
-async def process_prompt_with_context(prompt: str) -> str:
-    """Process a prompt with the global context using Ollama with streaming"""
-    try:
-        url = "http://localhost:11434/api/generate"
-        
-        context_text = "\n".join([
-            f"[{msg['date']}] {msg['sender']}: {msg['text']}"
-            for msg in global_context
-        ])
-        
-        full_prompt = f"""Previous context:
+class PromptSession:
+    """A /prompt conversation that continues from Ollama's returned context.
+
+    Every /api/generate answer ends with `context`, the tokens of the
+    conversation so far. Sending it back with the next question lets
+    Ollama reuse what it already evaluated, so a follow-up only costs its
+    own tokens. The first question carries the context messages relevant
+    to it; follow-ups only add relevant messages that were not sent yet.
+    The session starts over whenever the message context changes.
+    """
+
+    def __init__(self, messages: MessageContext):
+        self.messages = messages
+        self.reset()
+
+    def reset(self):
+        self.context: Optional[List[int]] = None
+        self.version = self.messages.version
+        self.sent: Set[MessageKey] = set()
+        self.turns = 0
+
+    @property
+    def is_follow_up(self) -> bool:
+        """Whether the next question continues the conversation"""
+        return self.context is not None and self.version == self.messages.version
+
+    def build_prompt(self, question: str) -> Tuple[str, List[MessageKey]]:
+        """Prompt text for question and the keys of the messages it carries"""
+        if not self.is_follow_up:
+            self.reset()
+        # Only the messages relevant to the question, plus the latest few
+        keys = [key for key in self.messages.select_relevant(question) if key not in self.sent]
+        context_text = self.messages.render_keys(keys)
+        if not self.turns:
+            prompt = f"""Previous context:
         {context_text}
 
         User question:
-        {prompt}
+        {question}
 
         Please provide a response taking into account the context above."""
-        
-        data = {
-            "model": "llama2",
-            "prompt": full_prompt,
-            "stream": True
-        }
-        
-        response = requests.post(url, json=data, stream=True)
-        response.raise_for_status()
-        
-        # Process the streaming response
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                try:
-                    json_response = json.loads(line.decode('utf-8'))
-                    if 'error' in json_response:
-                        return f"Error from API: {json_response['error']}"
-                    if 'response' in json_response:
-                        chunk = json_response['response']
-                        full_response += chunk
-                        sys.stdout.write(chunk)
-                        sys.stdout.flush()
-                        time.sleep(0.01)
-                except json.JSONDecodeError as e:
-                    print(f"\nWarning: Could not decode response: {str(e)}")
-                    continue
-                except Exception as e:
-                    print(f"\nWarning: Error processing chunk: {str(e)}")
-                    continue
-        
-        print()  # New line at the end
-        return full_response
-    except requests.exceptions.RequestException as e:
+        elif keys:
+            prompt = f"""More messages from the context:
+        {context_text}
+
+        Follow-up question:
+        {question}"""
+        else:
+            prompt = question
+        return prompt, keys
+
+    async def ask(self, question: str, on_chunk: Optional[Callable[[str], None]] = None,
+                  stats: Optional[GenerationStats] = None) -> str:
+        """Send question, streaming the answer to on_chunk; errors are raised"""
+        prompt, keys = self.build_prompt(question)
+        options = {'context': self.context} if self.context else {}
+        parts = []
+        context = None
+        async for json_response in get_llm_client().stream_generate(prompt, stats, **options):
+            chunk = json_response.get('response', '')
+            parts.append(chunk)
+            if on_chunk:
+                on_chunk(chunk)
+            if json_response.get('done'):
+                context = json_response.get('context')
+        # Without a returned context the next question starts a new session
+        self.context = context
+        self.sent.update(keys)
+        self.turns += 1
+        return "".join(parts)
+
+
+prompt_session = PromptSession(global_context)
+
+# A session of the running task's own, e.g. for one chat of a batch
+_task_session: ContextVar[Optional[PromptSession]] = ContextVar('prompt_session', default=None)
+
+def current_session() -> PromptSession:
+    """The prompt session of the running task, the global one by default"""
+    session = _task_session.get()
+    return session if session is not None else prompt_session
+
+def current_context() -> MessageContext:
+    """The message context of the running task, the global one by default"""
+    return current_session().messages
+
+def use_own_context():
+    """Give the running task, and the tasks it starts, an empty context and
+    prompt session of their own, so /add and /prompt do not mix with others"""
+    _task_session.set(PromptSession(MessageContext()))
+
+async def process_prompt_with_context(prompt: str, printer: Optional[TokenPrinter] = None,
+                                     stats: Optional[GenerationStats] = None) -> str:
+    """Process a prompt with the current context, streaming the answer to printer.
+
+    Follow-up prompts continue the conversation of the previous ones, see
+    PromptSession. Errors are raised, describe_llm_error explains them.
+    """
+    printer = printer or TokenPrinter()
+    try:
+        return await current_session().ask(prompt, printer.write, stats)
+    finally:
+        printer.finish()
+
+
+def describe_llm_error(e: Exception) -> str:
+    if isinstance(e, LLMError):
+        return f"Error from API: {str(e)}"
+    if isinstance(e, NETWORK_ERRORS):
         return f"Network error: {str(e)}"
-    except Exception as e:
-        return f"Unexpected error: {str(e)}"
+    return f"Unexpected error: {str(e)}"
 
 
 async def add_messages_to_context(formatted_messages: List[Dict]) -> str:
-    """Add formatted messages to global context"""
-    global global_context
-    
+    """Add formatted messages to the current context"""
     try:
-        for msg in formatted_messages:
-            if msg:  # Only add non-None messages
-                global_context.append(msg)
+        context = current_context()
+        # None entries (non-text messages) are skipped
+        added, duplicates, evicted = context.add(formatted_messages)
         
-        return f"Added {len(formatted_messages)} messages to context. Total context size: {len(global_context)} messages"
+        result = f"Added {added} messages to context"
+        if duplicates:
+            result += f" ({duplicates} already present)"
+        if evicted:
+            result += f", evicted {evicted} to stay within {context.budget} tokens"
+        return result + f". Total context size: {len(context)} messages, ~{context.tokens} tokens"
     except Exception as e:
         return f"Error adding to context: {str(e)}"
 
 def clear_global_context() -> str:
-    """Clear the global context"""
-    global global_context
-    context_size = len(global_context)
-    global_context = []
+    """Clear the current context"""
+    context_size = current_context().clear()
     return f"Cleared {context_size} messages from context"
 
-async def get_llm_summary(messages_text: str) -> str:
-    """Get a summary using local Ollama API"""
-    try:
-        url = "http://localhost:11434/api/generate"
-        
-        prompt = f"""Below are messages from a Telegram chat. 
+# Bump when the summary prompts change, so cached summaries are not reused
+SUMMARY_PROMPT_VERSION = 1
+
+def summary_prompt(messages_text: str) -> str:
+    return f"""Below are messages from a Telegram chat. 
         Please provide a brief, clear summary of the main discussion points:
 
         {messages_text}
         """
-        
-        data = {
-            "model": "llama2",
-            "prompt": prompt,
-            "stream": True
-        }
-        
-        response = requests.post(url, json=data)
-        response.raise_for_status()
-        return response.json()['response']
-    except Exception as e:
-        return f"Error getting LLM summary: {str(e)}"
\ No newline at end of file
+
+def combine_summaries_prompt(summaries_text: str) -> str:
+    return f"""Below are summaries of consecutive parts of one Telegram chat, oldest first.
+        Please combine them into a single brief, clear summary of the main discussion points:
+
+        {summaries_text}
+        """
+
+def update_summary_prompt(previous_summary: str, messages_text: str) -> str:
+    return f"""Below is a summary of a Telegram chat so far, followed by the messages sent since.
+        Please provide an updated brief, clear summary of the main discussion points:
+
+        Summary so far:
+        {previous_summary}
+
+        New messages:
+        {messages_text}
+        """
+
+def digest_prompt(chat_summaries_text: str) -> str:
+    return f"""Below are summaries of the unread messages in several Telegram chats.
+        Please write a short digest of what happened across them, most important first,
+        naming the chat for each point:
+
+        {chat_summaries_text}
+        """
+
+async def stream_llm_response(prompt: str,
+                              on_chunk: Optional[Callable[[str], None]] = None,
+                              stats: Optional[GenerationStats] = None) -> str:
+    """Run a prompt through the LLM, streaming chunks to on_chunk; errors are raised"""
+    parts = []
+    async for json_response in get_llm_client().stream_generate(prompt, stats):
+        chunk = json_response.get('response', '')
+        parts.append(chunk)
+        if on_chunk:
+            on_chunk(chunk)
+    return "".join(parts)
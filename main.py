@@ -1,142 +1,58 @@
+import time
+STARTED = time.perf_counter()  # For time to first frame
+
 from telethon import TelegramClient
+import argparse
 import asyncio
+import json
+import sys
 from dotenv import load_dotenv
 import os
-import curses
-from telegram_utils import get_last_messages, format_message, print_help, stream_print
-from llm_utils import (
-    show_global_context, process_prompt_with_context, add_messages_to_context,
-    clear_global_context, get_llm_summary
-)
-from message_viewer import view_messages
-
+# Before the project imports, which read their settings from the
+# environment when they are loaded
 load_dotenv()
 
+from telegram_utils import CHAT_COMMANDS, get_last_messages, format_message, print_help
+from llm_client import close_llm_client, GenerationStats
+from message_store import close_message_store, get_message_store, get_chat_id
+from dialog_model import DialogList
+from chat_navigator import navigate_chats
+from instrumentation import stats
+from line_editor import ainput, get_line_editor
+from exporter import EXPORT_DIR, EXPORT_FORMATS, export_chat, format_export_result
+from batch import (BATCH_PARALLELISM, EXIT_UNAUTHORIZED, EXIT_USAGE, GLOBAL_COMMANDS,
+                   check_command, run_batch)
+from media import download_message_media, format_size, message_body
+# The LLM modules (NumPy), the viewer and the digest are imported by the
+# commands that use them, so they do not delay the first chat list
+
 api_id = os.getenv('API_ID')    
 api_hash = os.getenv('API_HASH')
 session_name = os.getenv('SESSION_NAME')
 
-class ChatNavigator:
-    def __init__(self, stdscr, dialogs):
-        self.stdscr = stdscr
-        self.dialogs = dialogs
-        self.current_pos = 0
-        self.offset = 0
-        self.height, self.width = stdscr.getmaxyx()
-        self.max_visible = self.height - 4  # Leave space for header/footer
-        
-    def draw(self):
-        self.stdscr.clear()
-        
-        # Draw header
-        header = "Telegram Chats (↑/↓ to navigate, Enter to select, [ to go back, q to quit)"
-        self.stdscr.addstr(0, 0, header, curses.A_BOLD)
-        self.stdscr.addstr(1, 0, "=" * min(len(header), self.width))
-        
-        # Draw chats
-        for i in range(min(self.max_visible, len(self.dialogs))):
-            idx = i + self.offset
-            if idx >= len(self.dialogs):
-                break
-                
-            dialog = self.dialogs[idx]
-            line = f"{idx + 1}. {dialog.name}"
-            if dialog.unread_count > 0:
-                line += f" [{dialog.unread_count}]"
-                
-            y = i + 2  # Start after header
-            if idx == self.current_pos:
-                self.stdscr.attron(curses.A_REVERSE)
-                self.stdscr.addstr(y, 0, line[:self.width])
-                self.stdscr.attroff(curses.A_REVERSE)
-            else:
-                self.stdscr.addstr(y, 0, line[:self.width])
-        
-        # Draw scrollbar if needed
-        if len(self.dialogs) > self.max_visible:
-            scrollbar_height = int((self.max_visible / len(self.dialogs)) * self.max_visible)
-            scrollbar_pos = int((self.offset / len(self.dialogs)) * self.max_visible) + 2
-            for i in range(self.max_visible):
-                y = i + 2
-                if scrollbar_pos <= y < scrollbar_pos + scrollbar_height:
-                    self.stdscr.addstr(y, self.width - 1, "█")
-                else:
-                    self.stdscr.addstr(y, self.width - 1, "│")
-        
-        self.stdscr.refresh()
-    
-    def handle_key(self, key):
-        if key == curses.KEY_UP and self.current_pos > 0:
-            self.current_pos -= 1
-            if self.current_pos < self.offset:
-                self.offset = self.current_pos
-        
-        elif key == curses.KEY_DOWN and self.current_pos < len(self.dialogs) - 1:
-            self.current_pos += 1
-            if self.current_pos >= self.offset + self.max_visible:
-                self.offset = self.current_pos - self.max_visible + 1
-        
-        elif key == ord('\n'):  # Enter key
-            return self.dialogs[self.current_pos]
-        
-        elif key == ord('['):  # [ key
-            return 'back'
-        
-        elif key == ord('q'):  # q key
-            return 'quit'
-        
-        return None
+def show_summary_progress(done, total):
+    print(f"\rSummarized part {done}/{total}", end="\n" if done == total else "", flush=True)
 
-async def navigate_chats(dialogs):
-    def _navigate(stdscr):
-        # Setup curses
-        curses.curs_set(0)  # Hide cursor
-        stdscr.nodelay(0)   # Make getch() blocking
-        
-        navigator = ChatNavigator(stdscr, dialogs)
-        result = None
-        
-        while True:
-            navigator.draw()
-            key = stdscr.getch()
-            result = navigator.handle_key(key)
-            
-            if result is not None:
-                break
-        
-        return result
-    
-    # Run the curses application
-    return curses.wrapper(_navigate)
+def show_export_progress(count, seconds):
+    rate = count / seconds if seconds else 0
+    print(f"\rExported {count} messages ({rate:.0f} msgs/s)", end="", flush=True)
 
-async def summarize_messages(messages):
-    """Summarize messages using LLM"""
-    try:
-        formatted_msgs = []
-        for msg in messages:
-            if not msg.text:
-                continue
-            sender = (await msg.get_sender()) if msg.sender_id else None
-            sender_name = sender.username if sender and sender.username else (sender.first_name if sender else "Unknown")
-            formatted_msgs.append(f"{sender_name}: {msg.text}")
-        
-        if not formatted_msgs:
-            return "No text messages to summarize."
-            
-        messages_text = "\n".join(formatted_msgs)
-        summary = await get_llm_summary(messages_text)
-        return summary
-        
-    except Exception as e:
-        return f"Error creating summary: {str(e)}"
+def show_download_progress(done, total):
+    print(f"\rDownloaded {format_size(done)} of {format_size(total)}", end="", flush=True)
+
+async def handle_chat_commands(cmd, client, entity, chosen_dialog, dialog_list=None,
+                               interactive=True):
+    """Handle chat-level commands; without interactive, nothing is asked on stdin.
 
-async def handle_chat_commands(cmd, client, entity, chosen_dialog):
-    """Handle chat-level commands"""
+    Returns 'ok', 'usage' for bad arguments, 'error' when the command
+    failed or 'unknown' when cmd is not a chat command.
+    """
     if cmd == "/view":
+        from message_viewer import view_messages
         cmd = await view_messages(client, entity)
         if cmd:
-            return await handle_chat_commands(cmd, client, entity, chosen_dialog)
-        return True
+            return await handle_chat_commands(cmd, client, entity, chosen_dialog, dialog_list)
+        return 'ok'
 
     elif cmd.startswith("/read "):
         parts = cmd.split()
@@ -144,17 +60,49 @@ async def handle_chat_commands(cmd, client, entity, chosen_dialog):
             x = int(parts[1])
             msgs = await get_last_messages(client, entity, limit=x)
             for m in msgs:
-                sender = (await m.get_sender()) if m.sender_id else None
-                sender_name = sender.username if sender and sender.username else (sender.first_name if sender else "Unknown")
-                print(f"[{m.date.strftime('%Y-%m-%d %H:%M:%S')}] {sender_name}: {m.text or '(non-text message)'}")
+                print(f"[{m['date'].strftime('%Y-%m-%d %H:%M:%S')}] {m['sender']}: "
+                      f"{message_body(m['id'], m['text'], m['media'])}")
         else:
             print("Usage: /read x (where x is a number)")
+            return 'usage'
             
+    elif cmd.startswith("/search ") or cmd.startswith("/searchall "):
+        command, _, query = cmd.partition(" ")
+        chat_id = None if command == "/searchall" else get_chat_id(entity)
+        started = time.perf_counter()
+        results = get_message_store().search(query.strip(), chat_id=chat_id)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if not results:
+            print(f"No cached messages match '{query.strip()}'.")
+            return 'ok'
+        print(f"\n{len(results)} best matches ({elapsed_ms:.1f} ms):")
+        for i, hit in enumerate(results, 1):
+            where = f"{hit['chat_title']} / " if chat_id is None else ""
+            print(f"{i}. [{hit['date'].strftime('%Y-%m-%d %H:%M:%S')}] {where}{hit['sender']}: {hit['text'][:200]}")
+        if not interactive:
+            return 'ok'
+        try:
+            choice = (await ainput("Open result number (Enter to skip): ")).strip()
+        except EOFError:
+            return 'ok'
+        if choice.isdigit() and 1 <= int(choice) <= len(results):
+            hit = results[int(choice) - 1]
+            same_chat = hit['chat_id'] == get_chat_id(entity)
+            target = entity if same_chat else await client.get_entity(hit['chat_id'])
+            from message_viewer import view_messages
+            cmd = await view_messages(client, target, around_id=hit['id'])
+            if cmd and same_chat:
+                return await handle_chat_commands(cmd, client, entity, chosen_dialog, dialog_list)
+
     elif cmd == "/send":
-        text = input("Enter the message to send:\n").strip()
-        confirm = input("Send this message? (y/n): ").strip().lower()
+        try:
+            text = (await ainput("Enter the message to send:\n")).strip()
+            confirm = (await ainput("Send this message? (y/n): ")).strip().lower()
+        except EOFError:  # Ctrl-D cancels, as does the end of piped input
+            confirm = ''
         if confirm == 'y':
-            await client.send_message(entity, text)
+            with stats.timer('telegram.send_message.seconds'):
+                await client.send_message(entity, text)
             print("Message sent!")
         else:
             print("Message not sent.")
@@ -167,17 +115,26 @@ async def handle_chat_commands(cmd, client, entity, chosen_dialog):
                 print(f"\nFetching and summarizing last {x} messages...")
                 msgs = await get_last_messages(client, entity, limit=x)
                 if msgs:
-                    summary = await summarize_messages(msgs)
-                    print("\nSummary of conversation:")
-                    print("-" * 40)
-                    stream_print(summary)
+                    from llm_utils import TokenPrinter
+                    from summarizer import summarize_messages
+                    generation = GenerationStats()
+                    printer = TokenPrinter(header="\nSummary of conversation:\n" + "-" * 40 + "\n")
+                    summary = await summarize_messages(msgs, printer.write, generation, show_summary_progress)
+                    streamed = printer.written
+                    if not streamed:  # Cached summary
+                        printer.write(summary)
+                    printer.finish()
                     print("-" * 40)
+                    if streamed:
+                        print(f"({generation})")
                 else:
                     print("No messages found to summarize.")
             else:
                 print("Usage: /summarize x (where x is a number)")
+                return 'usage'
         except Exception as e:
             print(f"Error during summarization: {str(e)}")
+            return 'error'
     
     elif cmd.startswith("/add "):
         parts = cmd.split()
@@ -186,55 +143,174 @@ async def handle_chat_commands(cmd, client, entity, chosen_dialog):
             print(f"\nFetching last {x} messages to add to context...")
             msgs = await get_last_messages(client, entity, limit=x)
             if msgs:
-                formatted_msgs = [await format_message(msg) for msg in msgs]
+                from llm_utils import add_messages_to_context
+                formatted_msgs = [format_message(msg) for msg in msgs]
                 result = await add_messages_to_context(formatted_msgs)
                 print(result)
             else:
                 print("No messages found to add to context.")
         else:
             print("Usage: /add x (where x is a number)")
+            return 'usage'
     
-    elif cmd == "/prompt":
-        prompt = input("Enter your prompt:\n").strip()
-        print("\nProcessing prompt with context...")
+    elif cmd == "/prompt" or cmd.startswith("/prompt "):
+        from llm_utils import TokenPrinter, current_session, describe_llm_error, process_prompt_with_context
+        prompt = cmd[len("/prompt"):].strip()
+        if not prompt and interactive:
+            try:
+                prompt = (await ainput("Enter your prompt:\n")).strip()
+            except EOFError:
+                print("No prompt entered.")
+                return 'ok'
+        if not prompt:
+            print("Usage: /prompt [question]")
+            return 'usage'
+        session = current_session()
+        if session.is_follow_up:
+            print(f"\nContinuing the conversation (question {session.turns + 1})...")
+        else:
+            print("\nProcessing prompt with context...")
         print("-" * 40)
-        await process_prompt_with_context(prompt)
+        generation = GenerationStats()
+        printer = TokenPrinter()
+        try:
+            await process_prompt_with_context(prompt, printer, generation)
+        except Exception as e:
+            print(describe_llm_error(e))
+            print("-" * 40)
+            return 'error'
         print("-" * 40)
+        print(f"({generation})")
     
+    elif cmd == "/digest":
+        from digest import build_digest, unread_dialogs
+        from llm_utils import TokenPrinter
+        if dialog_list is not None:
+            await dialog_list.wait_loaded()  # Snapshot dialogs have no entity
+            all_dialogs = dialog_list.dialogs
+        else:
+            all_dialogs = [dialog async for dialog in client.iter_dialogs()]
+        unread = unread_dialogs(all_dialogs)
+        if not unread:
+            print("No chats with unread messages.")
+            return 'ok'
+        print(f"\nSummarizing unread messages of {len(unread)} chats...")
+
+        def show_chat_summary(dialog, count, summary):
+            print(f"\n== {dialog.name} ({count} unread) ==\n{summary.strip()}", flush=True)
+
+        generation = GenerationStats()
+        printer = TokenPrinter(header="\nDigest:\n" + "-" * 40 + "\n")
+        try:
+            await build_digest(client, unread, show_chat_summary, printer.write, generation)
+        except Exception as e:
+            printer.finish()
+            print(f"\nError creating digest: {str(e)}")
+            return 'error'
+        printer.finish()
+        if printer.written:
+            print("-" * 40)
+            print(f"({generation})")
+
+    elif cmd == "/export" or cmd.startswith("/export "):
+        parts = cmd.split()
+        fmt = parts[1] if len(parts) > 1 else 'jsonl'
+        if len(parts) > 2 or fmt not in EXPORT_FORMATS:
+            print("Usage: /export [jsonl|parquet]")
+            return 'usage'
+        else:
+            try:
+                print(f"\nExporting the full history of this chat as {fmt}...")
+                result = await export_chat(client, entity, fmt, on_progress=show_export_progress)
+                print()
+                print(format_export_result(result))
+            except Exception as e:
+                print(f"\nError during export: {str(e)}")
+                return 'error'
+
+    elif cmd == "/download" or cmd.startswith("/download "):
+        parts = cmd.split()
+        if len(parts) > 2 or (len(parts) == 2 and not parts[1].isdigit()):
+            print("Usage: /download [message id]")
+            return 'usage'
+        else:
+            try:
+                msg_id = int(parts[1]) if len(parts) == 2 else None
+                path = await download_message_media(client, entity, msg_id,
+                                                    on_progress=show_download_progress)
+                print(f"\nSaved to {path}")
+            except Exception as e:
+                print(f"\nError downloading media: {str(e)}")
+                return 'error'
+
     elif cmd == "/clear":
+        from llm_utils import clear_global_context
         result = clear_global_context()
         print(result)
     
     elif cmd == "/show":
+        from llm_utils import show_global_context
         context_display = show_global_context()
         print(context_display)
     
+    elif cmd == "/stats":
+        print(stats.report())
+
+    elif cmd == "/stats reset":
+        stats.reset()
+        print("Stats cleared.")
+
     elif cmd == "/help":
         print_help()
         
     else:
-        return False
+        return 'unknown'
         
-    return True
+    return 'ok'
 
-async def list_chats(client):
-    """List all available Telegram chats"""
-    dialogs = []
-    async for dialog in client.iter_dialogs():
-        dialogs.append(dialog)
-    return dialogs
+def record_first_frame():
+    stats.observe('startup.first_frame.seconds', time.perf_counter() - STARTED)
+
+async def connect(client, dialogs) -> bool:
+    """Connect and load the dialogs; False if the session has to log in first"""
+    await client.connect()
+    if not await client.is_user_authorized():
+        return False
+    dialogs.start_loading()
+    return True
 
 async def main():
-    async with TelegramClient(session_name, api_id, api_hash) as client:
-        print("Telegram client connected.")
-        
+    client = TelegramClient(session_name, api_id, api_hash)
+    # Loaded once, then kept current by update handlers
+    dialogs = DialogList(client)
+    connecting = None
+    # Commands are read without blocking, so updates keep being handled.
+    # Questions asked by the commands read through the same editor, so
+    # piped input is not split between two buffers.
+    commands = get_line_editor()
+    commands.completions = sorted(CHAT_COMMANDS)
+    try:
+        if dialogs.load_snapshot():
+            # Show the chat list of the last run while connecting
+            connecting = asyncio.ensure_future(connect(client, dialogs))
+        else:
+            await client.start()
+            print("Telegram client connected.")
+            dialogs.start_loading()
+
+        first_frame = record_first_frame
         while True:
-            # Get the list of dialogs
-            dialogs = await list_chats(client)
-            
             # Enter the chat navigation interface
-            result = await navigate_chats(dialogs)
-            
+            result = await navigate_chats(dialogs, first_frame)
+            first_frame = None
+
+            if connecting is not None and result != 'quit':
+                if not await connecting:
+                    await client.start()  # Prompts for the login, now that curses is gone
+                    dialogs.start_loading()
+                print("Telegram client connected.")
+                connecting = None
+
             if result == 'quit':
                 print("Exiting...")
                 break
@@ -243,7 +319,10 @@ async def main():
                 continue
                 
             elif result:  # Dialog selected
-                chosen_dialog = result
+                chosen_dialog = await dialogs.resolve(result)
+                if chosen_dialog is None:
+                    print(f"{result.name} is no longer in your chat list.")
+                    continue
                 entity = chosen_dialog.entity
                 # Clear screen after exiting curses
                 print("\033[H\033[J")  # ANSI escape sequence to clear screen
@@ -251,16 +330,124 @@ async def main():
                 print_help()
                 
                 while True:
-                    cmd = input(f"{chosen_dialog.name}> ").strip()
+                    try:
+                        cmd = (await commands.read_line(f"{chosen_dialog.name}> ")).strip()
+                    except EOFError:  # Ctrl-D or the end of piped input
+                        print("Exiting...")
+                        return
                     
                     if cmd == "/back":
                         print("Returning to chat selection...")
                         break
                         
                     # Handle all other commands
-                    handled = await handle_chat_commands(cmd, client, entity, chosen_dialog)
-                    if not handled:
+                    with stats.timer(f"command {cmd.split()[0] if cmd else '(empty)'}.seconds"):
+                        status = await handle_chat_commands(cmd, client, entity, chosen_dialog, dialogs)
+                    if status == 'unknown':
                         print("Unknown command. Type /help for a list of commands.")
+    finally:
+        dialogs.close()
+        if dialogs.loaded:
+            dialogs.save_snapshot()  # With the unread counts as they are now
+        if connecting is not None:
+            connecting.cancel()
+        await client.disconnect()
+
+async def find_chat(client, chat):
+    """Entity for a chat id, @username or dialog name, or None"""
+    try:
+        return await client.get_entity(int(chat) if chat.lstrip('-').isdigit() else chat)
+    except ValueError:
+        pass
+    # Not in the session's entity cache, or a display name
+    async for dialog in client.iter_dialogs():
+        if str(dialog.id) == chat or dialog.name.casefold() == chat.casefold():
+            return dialog.entity
+    return None
+
+async def export_main(args):
+    """Non-interactive export of one chat; returns the exit code"""
+    async with TelegramClient(session_name, api_id, api_hash) as client:
+        entity = await find_chat(client, args.chat)
+        if entity is None:
+            print(f"Chat not found: {args.chat}", file=sys.stderr)
+            return 1
+        try:
+            result = await export_chat(client, entity, args.format, args.output,
+                                       use_takeout=not args.no_takeout,
+                                       on_progress=show_export_progress)
+        except Exception as e:
+            print(f"\nError during export: {str(e)}", file=sys.stderr)
+            return 1
+        print()
+        print(format_export_result(result))
+        return 0
+
+async def batch_main(args):
+    """Run commands in several chats without a terminal; returns the exit code"""
+    problems = [f"{cmd}: {problem}" for cmd in args.commands
+                for problem in [check_command(cmd)] if problem]
+    if not args.chats and any(cmd.split()[0] not in GLOBAL_COMMANDS for cmd in args.commands):
+        problems.append("--chats is needed for commands other than " + ", ".join(GLOBAL_COMMANDS))
+    if problems:
+        print("\n".join(problems), file=sys.stderr)
+        return EXIT_USAGE
+    client = TelegramClient(session_name, api_id, api_hash)
+    await client.connect()
+    try:
+        if not await client.is_user_authorized():
+            print("Not logged in, run the interactive client once first.", file=sys.stderr)
+            return EXIT_UNAUTHORIZED
+
+        async def handle(cmd, client, entity):
+            return await handle_chat_commands(cmd, client, entity, None, interactive=False)
+
+        results = await run_batch(client, args.chats, args.commands, handle, find_chat,
+                                  args.parallelism)
+    finally:
+        await client.disconnect()
+    text = json.dumps(results, indent=2, ensure_ascii=False, default=str)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    return results['exit_code']
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram client with local LLM features")
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help="export a chat's full history and exit")
+    export.add_argument('chat', help="chat id, @username or dialog name")
+    export.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl')
+    export.add_argument('--output', default=EXPORT_DIR, help="output directory")
+    export.add_argument('--no-takeout', action='store_true',
+                        help="page history normally instead of in a takeout session")
+    batch = commands.add_parser('batch', help="run chat commands in several chats and exit",
+                                description="Exit codes: 0 success, 1 a command failed, 2 bad "
+                                            "arguments, 3 a chat was not found, 4 not logged in.")
+    batch.add_argument('--chats', nargs='*', default=[],
+                       help="chat ids, @usernames or dialog names")
+    batch.add_argument('--commands', nargs='+', required=True,
+                       help='commands run in each chat in order, e.g. "/summarize 200"; '
+                            f'{", ".join(GLOBAL_COMMANDS)} run once')
+    batch.add_argument('--parallelism', type=int, default=BATCH_PARALLELISM,
+                       help="chats processed at the same time")
+    batch.add_argument('--output', default='-', help="JSON results file, - for stdout")
+    return parser.parse_args(argv)
+
+async def run(args):
+    try:
+        if args.command == 'export':
+            return await export_main(args)
+        if args.command == 'batch':
+            return await batch_main(args)
+        await main()
+        return 0
+    finally:
+        await close_llm_client()
+        close_message_store()
+        stats.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    sys.exit(asyncio.run(run(parse_args())))
\ No newline at end of file
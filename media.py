@@ -0,0 +1,344 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from telethon.tl.types import PhotoStrippedSize
+
+from instrumentation import stats
+from message_store import get_chat_id, get_message_store
+
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', 'media_cache')
+# Thumbnails kept on disk, the least recently shown are removed beyond this
+MEDIA_CACHE_MB = float(os.getenv('MEDIA_CACHE_MB', '200'))
+# Thumbnails and metadata loaded at the same time while viewing a chat
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', '3'))
+MEDIA_BATCH = 20  # Message ids looked up per get_messages request
+# Requests waiting for a worker; the oldest have long scrolled out of view
+MEDIA_QUEUE_LIMIT = 200
+# Seconds a worker waits after a failed lookup, doubled per failure in a row
+MEDIA_RETRY = 1.0
+MEDIA_RETRY_MAX = 60.0
+THUMB_MAX_SIDE = 320  # Pixels, the largest thumbnail size up to this is used
+
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', 'downloads')
+# Chunks of a /download requested at the same time
+DOWNLOAD_PARALLELISM = int(os.getenv('DOWNLOAD_PARALLELISM', '4'))
+DOWNLOAD_CHUNK = 512 * 1024  # Largest request Telegram serves
+
+MEDIA_LABELS = {
+    'photo': "Photo", 'video_note': "Video message", 'voice': "Voice message",
+    'gif': "GIF", 'sticker': "Sticker", 'video': "Video", 'audio': "Audio",
+    'document': "File", 'geo': "Location", 'contact': "Contact", 'poll': "Poll",
+}
+# Kinds that may come with a thumbnail
+THUMB_KINDS = ('photo', 'video', 'gif', 'sticker', 'video_note', 'document', 'audio')
+
+LoadedCallback = Callable[[int, Optional[Dict]], None]
+ProgressCallback = Callable[[int, int], None]
+
+
+def format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} KB"
+    if size < 1024 ** 3:
+        return f"{size / 1024 ** 2:.1f} MB"
+    return f"{size / 1024 ** 3:.1f} GB"
+
+
+def describe_media(msg_id: int, media: Dict) -> str:
+    """Placeholder for a media message, e.g. "[Photo 1280x720, 245 KB #42]" """
+    kind = media['kind']
+    if kind == 'unknown':
+        return "[Media]"
+    details = [MEDIA_LABELS.get(kind, "Media")]
+    if media['name'] and kind in ('document', 'audio'):
+        details[0] += f" {media['name']}"
+    if media['width'] and media['height'] and kind in ('photo', 'video', 'gif'):
+        details[0] += f" {media['width']}x{media['height']}"
+    if media['duration']:
+        details.append(f"{media['duration'] // 60}:{media['duration'] % 60:02d}")
+    if media['size']:
+        details.append(format_size(media['size']))
+    return f"[{', '.join(details)} #{msg_id}]"
+
+
+def message_body(msg_id: int, text: str, media: Optional[Dict],
+                 preview: Optional[str] = None) -> str:
+    """Text of a message as shown to the user, media described in front of the caption"""
+    if not media:
+        return text or "(non-text message)"
+    parts = [describe_media(msg_id, media), text]
+    if preview:
+        parts.append(f"(preview: {preview})")
+    return " ".join(part for part in parts if part)
+
+
+def thumb_key(chat_id: int, msg_id: int) -> str:
+    return f"{chat_id}_{msg_id}"
+
+
+def pick_thumb(message) -> Optional[str]:
+    """Type of the largest thumbnail up to THUMB_MAX_SIDE, else the smallest one"""
+    if message.photo:
+        sizes = message.photo.sizes
+    elif message.document:
+        sizes = message.document.thumbs or []
+    else:
+        return None
+    sized = sorted((max(size.w, size.h), size.type) for size in sizes if getattr(size, 'w', None))
+    fitting = [size for size in sized if size[0] <= THUMB_MAX_SIDE]
+    if fitting:
+        return fitting[-1][1]
+    if sized:
+        return sized[0][1]
+    # Inline previews are part of the message, no download needed
+    return next((size.type for size in sizes if isinstance(size, PhotoStrippedSize)), None)
+
+
+def _image_ext(data: bytes) -> str:
+    if data.startswith(b'\x89PNG'):
+        return '.png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return '.jpg'
+
+
+class MediaCache:
+    """Files in a directory up to max_bytes in total, by key.
+
+    When full, the least recently used files are removed. Use is tracked
+    by modification time, so the order carries over between runs.
+    """
+
+    def __init__(self, directory: str = MEDIA_CACHE_DIR,
+                 max_bytes: int = int(MEDIA_CACHE_MB * 1024 * 1024)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # key -> (path, size), least recently used first
+        self._files: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self.size = 0
+        if os.path.isdir(directory):
+            entries = [entry for entry in os.scandir(directory)
+                       if entry.is_file() and not entry.name.endswith('.tmp')]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self._add(os.path.splitext(entry.name)[0], entry.path, entry.stat().st_size)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def _add(self, key: str, path: str, size: int):
+        old = self._files.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._files[key] = (path, size)
+        self.size += size
+
+    def get(self, key: str) -> Optional[str]:
+        """Path of the file for key, marking it as recently used"""
+        entry = self._files.get(key)
+        if entry is None:
+            return None
+        self._files.move_to_end(key)
+        try:
+            os.utime(entry[0])
+        except OSError:
+            del self._files[key]
+            self.size -= entry[1]
+            return None
+        return entry[0]
+
+    def put(self, key: str, data: bytes) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key + _image_ext(data))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        self._add(key, path, len(data))
+        self._evict()
+        return path
+
+    def _evict(self):
+        # The newest file stays even when it alone is over the limit
+        while self.size > self.max_bytes and len(self._files) > 1:
+            _, (path, size) = self._files.popitem(last=False)
+            self.size -= size
+            stats.count('media.cache_evictions')
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_cache: Optional[MediaCache] = None
+
+
+def get_media_cache() -> MediaCache:
+    """Return the process-wide thumbnail cache"""
+    global _cache
+    if _cache is None:
+        _cache = MediaCache()
+    return _cache
+
+
+class MediaLoader:
+    """Loads thumbnails and metadata of media messages in the background.
+
+    request() only queues message ids, so callers never wait. A fixed
+    number of workers take the most recently requested ids first, look
+    them up in batches, store their metadata, download missing thumbnails
+    into the cache and report each message through on_loaded(id, message);
+    message is None when it no longer exists. The ids of a failed lookup
+    can be requested again once the worker has waited out its backoff.
+    """
+
+    def __init__(self, client, entity, on_loaded: LoadedCallback,
+                 cache: Optional[MediaCache] = None, workers: int = MEDIA_WORKERS):
+        self.client = client
+        self.entity = entity
+        self.chat_id = get_chat_id(entity)
+        self.on_loaded = on_loaded
+        self.cache = cache if cache is not None else get_media_cache()
+        self._pending: "OrderedDict[int, None]" = OrderedDict()
+        self._requested = set()  # Pending, being loaded or done
+        self._wakeup = asyncio.Event()
+        self._failures = 0  # Failed lookups in a row
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(max(1, workers))]
+
+    def wants(self, msg_id: int, media: Dict) -> bool:
+        if msg_id in self._requested:
+            return False
+        return media['kind'] == 'unknown' or (
+            media['kind'] in THUMB_KINDS and thumb_key(self.chat_id, msg_id) not in self.cache)
+
+    def request(self, ids: Iterable[int]):
+        for msg_id in ids:
+            if msg_id not in self._requested:
+                self._requested.add(msg_id)
+                self._pending[msg_id] = None
+        while len(self._pending) > MEDIA_QUEUE_LIMIT:
+            msg_id, _ = self._pending.popitem(last=False)
+            self._requested.discard(msg_id)  # Asked for again once back in view
+        if self._pending:
+            self._wakeup.set()
+
+    async def _work(self):
+        while True:
+            await self._wakeup.wait()
+            batch = []
+            while self._pending and len(batch) < MEDIA_BATCH:
+                batch.append(self._pending.popitem()[0])
+            if not self._pending:
+                self._wakeup.clear()
+            if batch:
+                try:
+                    await self._load(batch)
+                    self._failures = 0
+                except Exception as e:
+                    stats.count('media.errors')
+                    self._failures += 1
+                    delay = min(MEDIA_RETRY * 2 ** (self._failures - 1), MEDIA_RETRY_MAX)
+                    # FloodWaitError says how long Telegram wants us to wait
+                    await asyncio.sleep(max(delay, getattr(e, 'seconds', 0)))
+                    self._requested.difference_update(batch)
+
+    async def _load(self, batch: List[int]):
+        with stats.timer('telegram.get_messages.seconds'):
+            messages = await self.client.get_messages(self.entity, ids=batch)
+        store = get_message_store()
+        for msg_id, message in zip(batch, messages):
+            if message is None:
+                store.delete_messages(self.chat_id, [msg_id])
+                self.on_loaded(msg_id, None)
+                continue
+            msg = await store.save_live(self.client, self.chat_id, message)
+            key = thumb_key(self.chat_id, msg_id)
+            thumb = pick_thumb(message)
+            if thumb is not None and key not in self.cache:
+                try:
+                    with stats.timer('telegram.thumbnail.seconds'):
+                        data = await self.client.download_media(message, file=bytes, thumb=thumb)
+                    if data:
+                        self.cache.put(key, data)
+                        stats.count('media.thumbnails')
+                except Exception:
+                    stats.count('media.errors')
+            self.on_loaded(msg_id, msg)
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+
+
+async def download_parallel(client, media, path: str, size: int,
+                            parallelism: int = DOWNLOAD_PARALLELISM,
+                            on_progress: Optional[ProgressCallback] = None):
+    """Download media of size bytes into path with parallel chunked requests.
+
+    Part i fetches chunks i, i + parts, i + 2 * parts and so on, so all
+    parts move through the file together; every chunk is written at its
+    own offset of the preallocated file.
+    """
+    chunks = -(-size // DOWNLOAD_CHUNK)
+    parts = max(1, min(parallelism, chunks))
+    stride = parts * DOWNLOAD_CHUNK
+    done = 0
+
+    async def fetch(part: int):
+        nonlocal done
+        offset = part * DOWNLOAD_CHUNK
+        with open(path, 'r+b') as f:
+            async for chunk in client.iter_download(
+                    media, offset=offset, stride=stride, limit=len(range(part, chunks, parts)),
+                    request_size=DOWNLOAD_CHUNK, file_size=size):
+                f.seek(offset)
+                f.write(chunk)
+                offset += stride
+                done += len(chunk)
+                if on_progress:
+                    on_progress(done, size)
+
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    tasks = [asyncio.ensure_future(fetch(part)) for part in range(parts)]
+    try:
+        with stats.timer('telegram.download.seconds'):
+            await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    stats.count('media.downloaded_bytes', done)
+
+
+async def download_message_media(client, entity, msg_id: Optional[int] = None,
+                                 out_dir: str = DOWNLOAD_DIR,
+                                 on_progress: Optional[ProgressCallback] = None) -> str:
+    """Save the file of message msg_id, or of the newest message with one, in
+    out_dir/<chat id>/"""
+    chat_id = get_chat_id(entity)
+    if msg_id is None:
+        store = get_message_store()
+        await store.sync(client, entity)
+        msg_id = store.last_media_id(chat_id)
+        if msg_id is None:
+            raise ValueError("no recent message in this chat has a file")
+    message = await client.get_messages(entity, ids=msg_id)
+    if message is None:
+        raise ValueError(f"message {msg_id} not found")
+    if message.file is None or not message.file.size:
+        raise ValueError(f"message {msg_id} has no file")
+    name = os.path.basename(message.file.name or "")
+    out_dir = os.path.join(out_dir, str(chat_id))
+    path = os.path.join(out_dir, f"{msg_id}-{name}" if name else f"{msg_id}{message.file.ext or ''}")
+    if os.path.exists(path) and os.path.getsize(path) == message.file.size:
+        return path
+    os.makedirs(out_dir, exist_ok=True)
+    await download_parallel(client, message, path + '.part', message.file.size,
+                            on_progress=on_progress)
+    os.replace(path + '.part', path)
+    return path
@@ -0,0 +1,241 @@
+import bisect
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class SenderTable:
+    """Interned sender names: every message stores a small index instead"""
+
+    def __init__(self):
+        self.names: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def intern(self, name: str) -> int:
+        index = self._index.get(name)
+        if index is None:
+            index = self._index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+
+class _Columns:
+    """One side of a MessageBuffer, a column per field"""
+    __slots__ = ('ids', 'dates', 'senders', 'texts', 'media')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.dates = array('q')  # Unix timestamps
+        self.senders = array('I')  # Indexes into the buffer's SenderTable
+        self.texts: List[str] = []
+        self.media: List[Optional[Dict]] = []  # None for text messages
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, msg_id: int, date: int, sender: int, text: str, media: Optional[Dict]):
+        self.ids.append(msg_id)
+        self.dates.append(date)
+        self.senders.append(sender)
+        self.texts.append(text)
+        self.media.append(media)
+
+    def set(self, pos: int, date: int, sender: int, text: str, media: Optional[Dict]):
+        self.dates[pos] = date
+        self.senders[pos] = sender
+        self.texts[pos] = text
+        self.media[pos] = media
+
+    def delete(self, pos: int):
+        for column in (self.ids, self.dates, self.senders, self.texts, self.media):
+            del column[pos]
+
+
+class MessageBuffer:
+    """The messages of an open chat in id order, stored column-wise.
+
+    Ids, dates and senders are arrays of machine integers with sender
+    names interned, so a text message costs about the size of its text. Each
+    column is split at the point where the buffer was first filled:
+    messages after it are appended to the back, older ones to the front,
+    which is kept in reverse order. Both ends therefore grow in amortized
+    O(1) and lookups by position or id stay O(1) and O(log n).
+    """
+
+    def __init__(self, messages: Iterable[Dict] = ()):
+        self.senders = SenderTable()
+        self._front = _Columns()
+        self._back = _Columns()
+        messages = list(messages)
+        if any(a['id'] >= b['id'] for a, b in zip(messages, messages[1:])):
+            messages.sort(key=lambda m: m['id'])
+        for msg in messages:
+            self.append(msg)
+
+    def __len__(self):
+        return len(self._front.ids) + len(self._back.ids)
+
+    def _side(self, index: int) -> Tuple[_Columns, int]:
+        front = len(self._front.ids)
+        if index < 0:
+            index += front + len(self._back.ids)
+        if 0 <= index < front:
+            return self._front, front - 1 - index
+        if not 0 <= index - front < len(self._back.ids):
+            raise IndexError("message index out of range")
+        return self._back, index - front
+
+    def _columns(self, msg: Dict) -> Tuple[int, int, str, Optional[Dict]]:
+        return (int(msg['date'].timestamp()), self.senders.intern(msg['sender']), msg['text'],
+                msg.get('media'))
+
+    def id_at(self, index: int) -> int:
+        side, pos = self._side(index)
+        return side.ids[pos]
+
+    def get(self, index: int) -> Tuple[int, int, str, str, Optional[Dict]]:
+        """(id, timestamp, sender, text, media) of the message at index"""
+        side, pos = self._side(index)
+        return (side.ids[pos], side.dates[pos], self.senders.names[side.senders[pos]],
+                side.texts[pos], side.media[pos])
+
+    def media_at(self, index: int) -> Optional[Dict]:
+        side, pos = self._side(index)
+        return side.media[pos]
+
+    @property
+    def first_id(self) -> Optional[int]:
+        if self._front:
+            return self._front.ids[-1]
+        return self._back.ids[0] if self._back else None
+
+    @property
+    def last_id(self) -> Optional[int]:
+        if self._back:
+            return self._back.ids[-1]
+        return self._front.ids[0] if self._front else None
+
+    def append(self, msg: Dict):
+        """Add a message newer than all others"""
+        last_id = self.last_id
+        if last_id is not None and msg['id'] <= last_id:
+            raise ValueError(f"message {msg['id']} is not newer than {last_id}")
+        self._back.append(msg['id'], *self._columns(msg))
+
+    def prepend(self, messages: List[Dict]):
+        """Add messages, oldest first, that are all older than the loaded ones"""
+        first_id = self.first_id
+        for msg in reversed(messages):
+            if first_id is not None and msg['id'] >= first_id:
+                raise ValueError(f"message {msg['id']} is not older than {first_id}")
+            self._front.append(msg['id'], *self._columns(msg))
+            first_id = msg['id']
+
+    def bisect(self, message_id: int) -> int:
+        """Index of the first message with an id of at least message_id"""
+        front = len(self._front)
+        if self._back and message_id >= self._back.ids[0]:
+            return front + bisect.bisect_left(self._back.ids, message_id)
+        # The front holds ids in descending order
+        return front - bisect.bisect_right(self._front.ids, -message_id, key=lambda i: -i)
+
+    def find(self, message_id: int) -> Optional[int]:
+        index = self.bisect(message_id)
+        if index < len(self) and self.id_at(index) == message_id:
+            return index
+        return None
+
+    def replace(self, index: int, msg: Dict):
+        """Swap in a new version of the message at index, e.g. after an edit"""
+        side, pos = self._side(index)
+        if side.ids[pos] != msg['id']:
+            raise ValueError(f"message {msg['id']} is not at index {index}")
+        side.set(pos, *self._columns(msg))
+
+    def remove_at(self, index: int):
+        side, pos = self._side(index)
+        side.delete(pos)
+
+    def remove(self, ids: Iterable[int]) -> bool:
+        """Drop the messages with the given ids; False when none was loaded"""
+        found = sorted({self.find(msg_id) for msg_id in ids} - {None}, reverse=True)
+        for index in found:
+            self.remove_at(index)
+        return bool(found)
+
+
+class LineIndex:
+    """Prefix sums of the wrapped heights of a MessageBuffer's messages.
+
+    Split and kept like the buffer's columns: the back holds the line
+    each message starts at relative to the split, the front the number
+    of lines from each message's start down to the split. Prepending
+    older messages therefore never shifts the entries already stored.
+    """
+
+    def __init__(self, heights: Iterable[int] = ()):
+        self._front = array('q')
+        self._back = array('q', [0])
+        for height in heights:
+            self.append(height)
+
+    def __len__(self):
+        return len(self._front) + len(self._back) - 1
+
+    @property
+    def _split(self) -> int:
+        return self._front[-1] if self._front else 0
+
+    @property
+    def total(self) -> int:
+        return self._split + self._back[-1]
+
+    def append(self, height: int):
+        self._back.append(self._back[-1] + height)
+
+    def prepend(self, heights: List[int]):
+        """Add the heights of messages prepended to the buffer, oldest first"""
+        for height in reversed(heights):
+            self._front.append(self._split + height)
+
+    def start(self, index: int) -> int:
+        """First line of message index; len(self) gives the total"""
+        front = len(self._front)
+        if index < front:
+            return self._split - self._front[front - 1 - index]
+        return self._split + self._back[index - front]
+
+    def height(self, index: int) -> int:
+        return self.start(index + 1) - self.start(index)
+
+    def _shift(self, index: int, delta: int):
+        """Add delta lines below the start of message index; only the
+        entries on the far side of it from the split move"""
+        front = len(self._front)
+        if index < front:
+            entries, first = self._front, front - 1 - index
+        else:
+            entries, first = self._back, index - front + 1
+        for i in range(first, len(entries)):
+            entries[i] += delta
+
+    def set_height(self, index: int, height: int):
+        """Change the height of message index, e.g. after an edit"""
+        delta = height - self.height(index)
+        if delta:
+            self._shift(index, delta)
+
+    def remove(self, index: int):
+        """Drop message index, as MessageBuffer.remove_at does"""
+        self._shift(index, -self.height(index))
+        front = len(self._front)
+        if index < front:
+            del self._front[front - 1 - index]
+        else:
+            del self._back[index - front + 1]
+
+    def find(self, line: int) -> int:
+        """Index of the message that line falls in, -1 above the first"""
+        front, split = len(self._front), self._split
+        if line >= split:
+            return front + bisect.bisect_right(self._back, line - split) - 1
+        return front - 1 - bisect.bisect_left(self._front, split - line)
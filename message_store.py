@@ -0,0 +1,554 @@
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import aclosing
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from telethon import utils
+from telethon.tl.types import MessageMediaWebPage
+
+from instrumentation import stats
+from range_fetcher import PARALLEL_FETCH_MIN, has_own_ids, iter_windows
+from sender_cache import resolve_sender_names, UNKNOWN_SENDER
+
+MESSAGE_STORE_PATH = os.getenv('MESSAGE_STORE_PATH', 'messages.db')
+
+# Messages fetched per request when catching up with new messages. If more
+# than this arrived since the last sync, the older part of the gap is only
+# fetched once somebody scrolls back to it.
+SYNC_BATCH = 200
+
+# Telegram is unreachable: serve what is cached instead
+OFFLINE_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS senders (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    sender_id INTEGER,
+    text TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (chat_id, id)
+);
+-- Id ranges [low, high] known to be fully present in messages
+CREATE TABLE IF NOT EXISTS spans (
+    chat_id INTEGER NOT NULL,
+    low INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, low)
+);
+"""
+
+# Full-text index over message text, kept in step with messages by triggers
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+"""
+
+# LLM summaries of message ranges, see summarizer.summarize_messages
+SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    chat_id INTEGER NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    prompt_version INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, model, prompt_version, last_id, first_id)
+);
+"""
+
+# What is attached to media messages, their text column holds the caption.
+# kind 'unknown' marks messages stored before media was recorded.
+MEDIA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    chat_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    mime_type TEXT,
+    name TEXT,
+    width INTEGER,
+    height INTEGER,
+    duration INTEGER,
+    PRIMARY KEY (chat_id, id)
+);
+"""
+
+# Message properties of Telethon, checked in order: a voice note is also a document
+MEDIA_KINDS = ('photo', 'video_note', 'voice', 'gif', 'sticker', 'video', 'audio',
+               'document', 'geo', 'contact', 'poll')
+MEDIA_FIELDS = ('kind', 'size', 'mime_type', 'name', 'width', 'height', 'duration')
+
+# The chat list as of the last run, drawn at startup before Telegram answers
+DIALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dialog_snapshot (
+    position INTEGER PRIMARY KEY,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    unread_count INTEGER NOT NULL,
+    pinned INTEGER NOT NULL,
+    read_inbox_max_id INTEGER NOT NULL
+);
+"""
+
+# Upsert rather than INSERT OR REPLACE, whose implicit delete would bypass
+# the full-text triggers
+UPSERT_MESSAGES = """
+    INSERT INTO messages VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (chat_id, id) DO UPDATE SET
+        date = excluded.date, sender_id = excluded.sender_id, text = excluded.text
+"""
+
+UPSERT_MEDIA = "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+MESSAGE_COLUMNS = """
+    SELECT m.chat_id, m.id, m.date, m.sender_id, COALESCE(s.name, ?), m.text,
+           d.kind, d.size, d.mime_type, d.name, d.width, d.height, d.duration
+    FROM messages m LEFT JOIN senders s ON s.id = m.sender_id
+    LEFT JOIN media d ON d.chat_id = m.chat_id AND d.id = m.id
+"""
+
+
+def get_chat_id(entity) -> int:
+    """Marked peer id of a chat entity, as used for the chat_id column"""
+    return utils.get_peer_id(entity)
+
+
+def media_info(message) -> Optional[Tuple]:
+    """(kind, size, mime_type, name, width, height, duration) of a message's
+    media, None for plain text and link previews"""
+    media = getattr(message, 'media', None)
+    if media is None or isinstance(media, MessageMediaWebPage):
+        return None
+    kind = next((kind for kind in MEDIA_KINDS if getattr(message, kind, None)), 'other')
+    file = message.file
+    if file is None:
+        return (kind, None, None, None, None, None, None)
+    duration = file.duration
+    return (kind, file.size, file.mime_type, file.name, file.width, file.height,
+            int(duration) if duration is not None else None)
+
+
+def _row_to_message(row) -> Dict:
+    chat_id, msg_id, date, sender_id, sender, text = row[:6]
+    return {
+        'chat_id': chat_id,
+        'id': msg_id,
+        'date': datetime.fromtimestamp(date, tz=timezone.utc),
+        'sender_id': sender_id,
+        'sender': sender,
+        'text': text,
+        'media': dict(zip(MEDIA_FIELDS, row[6:13])) if row[6] is not None else None,
+    }
+
+
+class MessageStore:
+    """SQLite cache of chat history, synced incrementally from Telegram.
+
+    Every chat keeps a list of spans, id ranges whose messages are all
+    stored. Reads are served from the newest span and only the missing
+    ends are fetched: new messages above it and, when a caller asks for
+    more history than it holds, older messages below it.
+    """
+
+    def __init__(self, path: str = MESSAGE_STORE_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        has_search = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        has_media = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'media'").fetchone()
+        self.db.executescript(SEARCH_SCHEMA)
+        self.db.executescript(SUMMARY_SCHEMA)
+        self.db.executescript(DIALOG_SCHEMA)
+        self.db.executescript(MEDIA_SCHEMA)
+        if not has_search:
+            # Index messages stored before search existed
+            self.db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+            self.db.commit()
+        if not has_media:
+            # Messages without text stored before media was recorded may be
+            # media; the viewer loads what they are when they come into view
+            self.db.execute("INSERT INTO media (chat_id, id, kind) "
+                            "SELECT chat_id, id, 'unknown' FROM messages WHERE text = ''")
+            self.db.commit()
+        self.offline = False
+
+    def close(self):
+        self.db.close()
+
+    # Spans
+
+    def _spans(self, chat_id: int) -> List[Tuple[int, int]]:
+        return self.db.execute(
+            "SELECT low, high FROM spans WHERE chat_id = ? ORDER BY high DESC", (chat_id,)
+        ).fetchall()
+
+    def _span_containing(self, chat_id: int, msg_id: int) -> Optional[Tuple[int, int]]:
+        return self.db.execute(
+            "SELECT low, high FROM spans WHERE chat_id = ? AND low <= ? AND high >= ?",
+            (chat_id, msg_id, msg_id)
+        ).fetchone()
+
+    def _add_span(self, chat_id: int, low: int, high: int):
+        """Record [low, high] as complete, merging overlapping or touching spans"""
+        touching = self.db.execute(
+            "SELECT low, high FROM spans WHERE chat_id = ? AND low <= ? AND high >= ?",
+            (chat_id, high + 1, low - 1)
+        ).fetchall()
+        for span_low, span_high in touching:
+            low, high = min(low, span_low), max(high, span_high)
+        self.db.execute(
+            "DELETE FROM spans WHERE chat_id = ? AND low <= ? AND high >= ?",
+            (chat_id, high + 1, low - 1)
+        )
+        self.db.execute("INSERT INTO spans VALUES (?, ?, ?)", (chat_id, low, high))
+
+    # Fetching
+
+    async def _save(self, client, chat_id: int, messages: List):
+        if not messages:
+            return
+        sender_names = await resolve_sender_names(client, messages)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO senders VALUES (?, ?)",
+            [(sender_id, name) for sender_id, name in sender_names.items()
+             if name != UNKNOWN_SENDER]
+        )
+        self.db.executemany(
+            UPSERT_MESSAGES,
+            [(chat_id, m.id, int(m.date.timestamp()), m.sender_id, m.text or '')
+             for m in messages]
+        )
+        media = [(m, media_info(m)) for m in messages]
+        self.db.executemany(
+            UPSERT_MEDIA,
+            [(chat_id, m.id) + info for m, info in media if info is not None]
+        )
+        # Only messages without text can have a stale 'unknown' row
+        self.db.executemany(
+            "DELETE FROM media WHERE chat_id = ? AND id = ?",
+            [(chat_id, m.id) for m, info in media if info is None and not m.text]
+        )
+
+    async def _fetch(self, client, entity, chat_id: int, limit: int,
+                     min_id: int = 0, max_id: int = 0, reverse: bool = False) -> List:
+        """Fetch up to limit messages strictly between min_id and max_id.
+
+        Messages come newest first, or oldest first with reverse. A max_id
+        of 0 means "up to the newest message". The range that is now known
+        to be complete is recorded as a span. Large pulls newest first from
+        channels and supergroups are split into id windows fetched in
+        parallel, see _fetch_windows.
+        """
+        if limit >= PARALLEL_FETCH_MIN and not reverse and has_own_ids(entity):
+            return await self._fetch_windows(client, entity, chat_id, limit, min_id, max_id)
+        with stats.timer('telegram.iter_messages.seconds'):
+            messages = [m async for m in client.iter_messages(
+                entity, limit=limit, min_id=min_id, max_id=max_id, reverse=reverse)]
+        stats.count('telegram.iter_messages')
+        stats.count('telegram.history_pages', len(messages) // 100 + 1)  # Telethon pages by 100
+        stats.count('messages.fetched', len(messages))
+        await self._save(client, chat_id, messages)
+
+        ids = sorted(m.id for m in messages)
+        full = len(messages) == limit
+        if reverse:
+            low = min_id + 1
+            high = ids[-1] if full else (max_id - 1 if max_id else (ids[-1] if ids else min_id))
+        else:
+            high = max_id - 1 if max_id else (ids[-1] if ids else min_id)
+            low = ids[0] if full else min_id + 1
+        if high >= low:
+            self._add_span(chat_id, low, high)
+        self.db.commit()
+        return messages
+
+    async def _fetch_windows(self, client, entity, chat_id: int, limit: int,
+                             min_id: int, max_id: int) -> List:
+        """_fetch for large pulls: every window is saved and recorded as a
+        span as soon as it and all newer windows have arrived"""
+        fetched = []
+        top = max_id - 1 if max_id else None  # Upper end of the next span
+        with stats.timer('telegram.iter_messages.seconds'):
+            windows = iter_windows(client, entity, limit, min_id, max_id)
+            async with aclosing(windows):
+                async for low, high, messages in windows:
+                    await self._save(client, chat_id, messages)
+                    # Without max_id the first window reaches up to the newest message
+                    self._add_span(chat_id, low, top if top is not None else high)
+                    top = low - 1
+                    self.db.commit()
+                    fetched.extend(messages)
+        stats.count('telegram.iter_messages')
+        stats.count('messages.fetched', len(fetched))
+        if max_id and top == max_id - 1 and top > min_id:
+            # No message at all between min_id and max_id
+            self._add_span(chat_id, min_id + 1, top)
+            self.db.commit()
+        return fetched[:limit]
+
+    async def _remote(self, coro):
+        """Run a Telegram fetch, switching to offline mode if it cannot connect"""
+        try:
+            result = await coro
+        except OFFLINE_ERRORS:
+            self.offline = True
+            return None
+        self.offline = False
+        return result
+
+    def _remember_chat(self, entity, chat_id: int):
+        self.db.execute(
+            "INSERT OR REPLACE INTO chats VALUES (?, ?)",
+            (chat_id, utils.get_display_name(entity))
+        )
+
+    async def sync(self, client, entity, limit: int = SYNC_BATCH) -> Optional[Tuple[int, int]]:
+        """Fetch messages newer than the newest stored one and return the newest span"""
+        chat_id = get_chat_id(entity)
+        self._remember_chat(entity, chat_id)
+        spans = self._spans(chat_id)
+        newest = spans[0][1] if spans else 0
+        await self._remote(self._fetch(
+            client, entity, chat_id, max(limit, SYNC_BATCH), min_id=newest))
+        spans = self._spans(chat_id)
+        return spans[0] if spans else None
+
+    async def _extend_below(self, client, entity, chat_id: int, span: Tuple[int, int],
+                            before_id: int, limit: int) -> Tuple[int, int]:
+        """Grow span downwards until it holds limit messages below before_id"""
+        while span[0] > 1 and not self.offline:
+            have = self.db.execute(
+                "SELECT COUNT(*) FROM messages WHERE chat_id = ? AND id >= ? AND id < ?",
+                (chat_id, span[0], before_id)
+            ).fetchone()[0]
+            if have >= limit:
+                break
+            fetched = await self._remote(self._fetch(
+                client, entity, chat_id, limit - have, max_id=span[0]))
+            if fetched is None:
+                break
+            span = self._span_containing(chat_id, span[0])
+        return span
+
+    def _query(self, where: str, params: tuple, limit: int) -> List[Dict]:
+        rows = self.db.execute(
+            f"{MESSAGE_COLUMNS} WHERE {where} ORDER BY m.id DESC LIMIT ?",
+            (UNKNOWN_SENDER,) + params + (limit,)
+        ).fetchall()
+        return [_row_to_message(row) for row in reversed(rows)]
+
+    async def get_last(self, client, entity, limit: int) -> List[Dict]:
+        """Last limit messages of a chat, oldest first"""
+        chat_id = get_chat_id(entity)
+        span = await self.sync(client, entity, limit)
+        if span is None or self.offline:
+            return self.cached_last(chat_id, limit)
+        span = await self._extend_below(client, entity, chat_id, span, span[1] + 1, limit)
+        return self._query("m.chat_id = ? AND m.id >= ?", (chat_id, span[0]), limit)
+
+    async def get_older(self, client, entity, before_id: int, limit: int) -> List[Dict]:
+        """Up to limit messages older than before_id, oldest first"""
+        chat_id = get_chat_id(entity)
+        span = self._span_containing(chat_id, before_id - 1)
+        if span is None:
+            # Before an unsynced gap: the next older block starts right below
+            span = (before_id, before_id - 1)
+            await self._remote(self._fetch(client, entity, chat_id, limit, max_id=before_id))
+            span = self._span_containing(chat_id, before_id - 1) or span
+        if not self.offline:
+            span = await self._extend_below(client, entity, chat_id, span, before_id, limit)
+        if self.offline:
+            return self._query("m.chat_id = ? AND m.id < ?", (chat_id, before_id), limit)
+        return self._query("m.chat_id = ? AND m.id >= ? AND m.id < ?",
+                           (chat_id, span[0], before_id), limit)
+
+    async def get_newer(self, client, entity, after_id: int, limit: int) -> List[Dict]:
+        """Up to limit messages newer than after_id, oldest first"""
+        chat_id = get_chat_id(entity)
+        span = self._span_containing(chat_id, after_id)
+        if span is None:
+            await self._remote(self._fetch(
+                client, entity, chat_id, limit, min_id=after_id, reverse=True))
+        else:
+            have = self.db.execute(
+                "SELECT COUNT(*) FROM messages WHERE chat_id = ? AND id > ? AND id <= ?",
+                (chat_id, after_id, span[1])
+            ).fetchone()[0]
+            if have < limit:
+                # Fill upwards from the end of the span
+                await self._remote(self._fetch(
+                    client, entity, chat_id, limit - have, min_id=span[1], reverse=True))
+
+        where, params = "m.chat_id = ? AND m.id > ?", (chat_id, after_id)
+        span = self._span_containing(chat_id, after_id + 1) or self._span_containing(chat_id, after_id)
+        if span is not None and not self.offline:
+            where, params = where + " AND m.id <= ?", params + (span[1],)
+        rows = self.db.execute(
+            f"{MESSAGE_COLUMNS} WHERE {where} ORDER BY m.id LIMIT ?",
+            (UNKNOWN_SENDER,) + params + (limit,)
+        ).fetchall()
+        return [_row_to_message(row) for row in rows]
+
+    def search(self, query: str, chat_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+        """Best matches for query among stored messages, optionally in one chat.
+
+        Every word of the query has to match, the last one as a prefix.
+        Results carry the chat title and are ranked by bm25.
+        """
+        words = [word.replace('"', '""') for word in query.split()]
+        if not words:
+            return []
+        match = " ".join(f'"{word}"' for word in words) + "*"
+        where = "messages_fts MATCH ?"
+        params: tuple = (match,)
+        if chat_id is not None:
+            where += " AND m.chat_id = ?"
+            params += (chat_id,)
+        rows = self.db.execute(
+            f"""SELECT m.chat_id, m.id, m.date, m.sender_id, COALESCE(s.name, ?), m.text,
+                       d.kind, d.size, d.mime_type, d.name, d.width, d.height, d.duration,
+                       COALESCE(c.title, m.chat_id)
+                FROM messages_fts
+                JOIN messages m ON m.rowid = messages_fts.rowid
+                LEFT JOIN senders s ON s.id = m.sender_id
+                LEFT JOIN media d ON d.chat_id = m.chat_id AND d.id = m.id
+                LEFT JOIN chats c ON c.id = m.chat_id
+                WHERE {where} ORDER BY messages_fts.rank LIMIT ?""",
+            (UNKNOWN_SENDER,) + params + (limit,)
+        ).fetchall()
+        results = []
+        for row in rows:
+            result = _row_to_message(row)
+            result['chat_title'] = row[13]
+            results.append(result)
+        return results
+
+    def get_summary(self, chat_id: int, first_id: int, last_id: int,
+                    model: str, prompt_version: int) -> Optional[str]:
+        """Cached summary of exactly the messages first_id..last_id"""
+        row = self.db.execute(
+            """SELECT summary FROM summaries WHERE chat_id = ? AND model = ?
+               AND prompt_version = ? AND last_id = ? AND first_id = ?""",
+            (chat_id, model, prompt_version, last_id, first_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_summary_overlapping(self, chat_id: int, first_id: int, last_id: int,
+                                model: str, prompt_version: int,
+                                overhang: int = 0) -> Optional[Tuple[int, int, str]]:
+        """Cached (first_id, last_id, summary) covering the most of first_id..last_id,
+        to be extended with the messages around it.
+
+        The range has to end inside first_id..last_id and may start up to
+        overhang ids before it, as the previous /summarize of a chat that
+        has moved on since does.
+        """
+        return self.db.execute(
+            """SELECT first_id, last_id, summary FROM summaries
+               WHERE chat_id = ? AND model = ? AND prompt_version = ?
+               AND first_id >= ? AND last_id >= ? AND last_id <= ?
+               ORDER BY last_id - MAX(first_id, ?) DESC, MAX(? - first_id, 0) LIMIT 1""",
+            (chat_id, model, prompt_version, first_id - overhang, first_id, last_id,
+             first_id, first_id)
+        ).fetchone()
+
+    def save_summary(self, chat_id: int, first_id: int, last_id: int,
+                     model: str, prompt_version: int, summary: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, first_id, last_id, model, prompt_version, summary, int(time.time()))
+        )
+        self.db.commit()
+
+    def cached_last(self, chat_id: int, limit: int) -> List[Dict]:
+        """Last limit stored messages of a chat without touching the network"""
+        return self._query("m.chat_id = ?", (chat_id,), limit)
+
+    async def save_live(self, client, chat_id: int, message) -> Dict:
+        """Store a message that arrived or changed while the chat is open.
+
+        Spans are left alone: the next sync fills any gap before it.
+        """
+        await self._save(client, chat_id, [message])
+        self.db.commit()
+        return self._query("m.chat_id = ? AND m.id = ?", (chat_id, message.id), 1)[0]
+
+    def delete_messages(self, chat_id: int, ids: List[int]):
+        for table in ('messages', 'media'):
+            self.db.executemany(
+                f"DELETE FROM {table} WHERE chat_id = ? AND id = ?",
+                [(chat_id, msg_id) for msg_id in ids]
+            )
+        self.db.commit()
+
+    def last_media_id(self, chat_id: int) -> Optional[int]:
+        """Id of the newest stored message that has a file attached"""
+        row = self.db.execute(
+            "SELECT MAX(id) FROM media WHERE chat_id = ? AND size IS NOT NULL", (chat_id,)
+        ).fetchone()
+        return row[0]
+
+    # Dialog snapshot
+
+    def save_dialogs(self, dialogs: List[Tuple[int, str, int, bool, int]]):
+        """Replace the snapshot with (id, name, unread_count, pinned, read_inbox_max_id) rows"""
+        self.db.execute("DELETE FROM dialog_snapshot")
+        self.db.executemany(
+            "INSERT INTO dialog_snapshot VALUES (?, ?, ?, ?, ?, ?)",
+            [(position,) + tuple(dialog) for position, dialog in enumerate(dialogs)]
+        )
+        self.db.commit()
+
+    def load_dialogs(self) -> List[Tuple[int, str, int, bool, int]]:
+        return [
+            (dialog_id, name, unread_count, bool(pinned), read_inbox_max_id)
+            for dialog_id, name, unread_count, pinned, read_inbox_max_id in self.db.execute(
+                "SELECT id, name, unread_count, pinned, read_inbox_max_id "
+                "FROM dialog_snapshot ORDER BY position")
+        ]
+
+
+_store: Optional[MessageStore] = None
+
+
+def get_message_store() -> MessageStore:
+    """Return the process-wide message store"""
+    global _store
+    if _store is None:
+        _store = MessageStore()
+    return _store
+
+
+def close_message_store():
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
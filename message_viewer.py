@@ -1,35 +1,66 @@
 import curses
 import locale
+import time
+from collections import OrderedDict
+from telethon import events
 from telethon.tl.types import User, Chat, Channel
 import asyncio
+from instrumentation import stats
+from media import MediaLoader, get_media_cache, message_body, thumb_key
+from message_buffer import LineIndex, MessageBuffer
+from message_store import get_message_store, get_chat_id
+from async_curses import curses_screen, KeyReader
 
 locale.setlocale(locale.LC_ALL, '')
 
 KEY_UP = curses.KEY_UP
 KEY_DOWN = curses.KEY_DOWN
 
+PAGE_SIZE = 100  # Messages per fetch of older history
+PREFETCH_SCREENS = 2  # Prefetch once the view is this many screens from the top
+PREFETCH_RETRY = 1.0  # Seconds before a failed page is fetched again, doubled per failure
+PREFETCH_RETRY_MAX = 30.0
+LAYOUT_CACHE_SIZE = 2048  # Wrapped messages kept, a few screens' worth is enough
+
+def wrap_line(line, width):
+    """Word-wrap a line to width columns, splitting long words if needed"""
+    lines = []
+    remaining = line
+    while remaining:
+        if len(remaining) > width:
+            split_point = remaining.rfind(' ', 0, width)
+            if split_point <= 0:
+                split_point = width
+            lines.append(remaining[:split_point])
+            remaining = remaining[split_point:].strip()
+        else:
+            lines.append(remaining)
+            remaining = ''
+    return lines or ['']
+
 class MessageViewer:
-    def __init__(self, stdscr, messages, entity, client, loop, current_offset):
+    def __init__(self, stdscr, messages, entity, client, top_message_id=None, media_cache=None):
         self.stdscr = stdscr
-        self.messages = list(sorted(messages, key=lambda m: m['id'], reverse=False))
-        # self.messages = list(reversed(messages))
+        self.messages = MessageBuffer(messages)
         self.entity = entity
         self.client = client
-        self.loop = loop
         self.entity_name = self.get_entity_name(entity)
-        self.current_pos = len(self.messages) - 1
+        self.chat_id = get_chat_id(entity)
+        self.media_cache = media_cache  # Thumbnails shown as previews when given
         self.height, self.width = stdscr.getmaxyx()
-        self.max_visible = self.height - 4
-        if current_offset == -1:
-            self.offset = max(0, self.current_pos - self.max_visible + 1)
-        else:
-            self.offset = current_offset
         self.command_mode = False
         self.command_buffer = ""
-        self.oldest_message_id = min(msg['id'] for msg in messages) if messages else None
-        # self.oldest_message_id = self.messages[0]['id'] if self.messages else None  # track oldest loaded message ID
-    
-        
+        self.status = ""  # Shown next to the header, e.g. while history loads
+        # Wrapped lines of recently drawn messages by (message id, width),
+        # least recently used first; line heights live in self.lines
+        self._layout = OrderedDict()
+        self._frame = []  # Rows as last written to the screen, for diffing
+        self._frame_top = 0  # top_line of the last frame
+        self.resize()
+        self.top_line = self.max_top_line()
+        if top_message_id is not None:
+            self.scroll_to_message(top_message_id)
+
     def get_entity_name(self, entity):
         if isinstance(entity, User):
             return entity.first_name or entity.username or "User"
@@ -37,46 +68,208 @@ class MessageViewer:
             return entity.title
         return str(entity)
 
-    def draw(self, last_y=None):
-        if last_y is None:
-            self.stdscr.clear()
-            header = f"Messages (↑/↓ to scroll, / for commands, q to exit) - {self.entity_name}"
-            self.safe_addstr(0, 0, header, curses.A_BOLD)
-            self.safe_addstr(1, 0, "=" * (self.width-1))
-            current_y = self.height - 2
-        else:
-            current_y = last_y
-
-        visible_messages = self.messages[self.offset:self.offset + self.max_visible]
-
-        for msg in reversed(visible_messages):
-            date_str = msg['date'].strftime('%H:%M:%S')
-            line = f"[{date_str}] {msg['sender']}: {msg['text']}"
-
-            remaining = line
-            while remaining and current_y > 1:
-                space_left = self.width - 1
-                if len(remaining) > space_left:
-                    split_point = remaining[:space_left].rfind(' ')
-                    if split_point == -1:
-                        split_point = space_left
-                    self.safe_addstr(current_y, 0, remaining[:split_point])
-                    remaining = remaining[split_point:].strip()
-                else:
-                    self.safe_addstr(current_y, 0, remaining)
-                    remaining = ''
-                current_y -= 1
+    def resize(self):
+        """Pick up the terminal size and re-wrap for the new width"""
+        self.height, self.width = self.stdscr.getmaxyx()
+        self.view_height = max(1, self.height - 3)  # Header takes 2 rows, command line 1
+        self._layout.clear()
+        self._frame = []
+        self.stdscr.erase()
+        self.rebuild_index()
+
+    @property
+    def oldest_message_id(self):
+        return self.messages.first_id
+
+    def wrapped(self, idx):
+        """Wrapped lines of the message at index idx"""
+        key = (self.messages.id_at(idx), self.width)
+        lines = self._layout.get(key)
+        if lines is not None:
+            self._layout.move_to_end(key)
+            return lines
+        msg_id, date, sender, text, media = self.messages.get(idx)
+        preview = None
+        if media and self.media_cache is not None:
+            preview = self.media_cache.get(thumb_key(self.chat_id, msg_id))
+        date_str = time.strftime('%H:%M:%S', time.gmtime(date))
+        body = message_body(msg_id, text, media, preview)
+        lines = wrap_line(f"[{date_str}] {sender}: {body}", self.width - 1)
+        self._layout[key] = lines
+        if len(self._layout) > LAYOUT_CACHE_SIZE:
+            self._layout.popitem(last=False)
+        return lines
+
+    def rebuild_index(self):
+        """Line index of the wrapped heights: message i starts at lines.start(i)"""
+        self.lines = LineIndex(len(self.wrapped(idx)) for idx in range(len(self.messages)))
+
+    @property
+    def total_lines(self):
+        return self.lines.total
+
+    def max_top_line(self):
+        return max(0, self.total_lines - self.view_height)
+
+    def scroll_to_message(self, message_id):
+        idx = self.messages.bisect(message_id)
+        if idx < len(self.messages):
+            self.top_line = min(self.lines.start(idx), self.max_top_line())
+
+    def prepend_messages(self, older):
+        """Add older messages above the loaded ones without moving the view"""
+        if not older:
+            return
+        old_total = self.total_lines
+        self.messages.prepend(older)
+        self.lines.prepend([len(self.wrapped(idx)) for idx in range(len(older))])
+        self.top_line = min(self.top_line + self.total_lines - old_total, self.max_top_line())
+        self._frame_top += self.total_lines - old_total
+
+    def append_messages(self, newer):
+        """Add newer messages below the loaded ones"""
+        for msg in newer:
+            self.messages.append(msg)
+            self.lines.append(len(self.wrapped(len(self.messages) - 1)))
+
+    def add_live_message(self, msg):
+        """Append a message that just arrived, following it only when the
+        view is already at the bottom"""
+        if self.messages and msg['id'] <= self.messages.last_id:
+            self.update_message(msg)
+            return
+        at_bottom = self.top_line >= self.max_top_line()
+        self.append_messages([msg])
+        if at_bottom:
+            self.top_line = self.max_top_line()
+
+    def _anchor(self):
+        """The message at the top of the view, the line offset into it and
+        whether the view is at the bottom"""
+        if not self.messages:
+            return None
+        idx = min(self.lines.find(self.top_line), len(self.messages) - 1)
+        return (self.messages.id_at(idx), self.top_line - self.lines.start(idx),
+                self.top_line >= self.max_top_line())
+
+    def _restore(self, anchor):
+        """Keep anchor in place after messages changed height or were removed"""
+        if anchor is None:
+            return
+        old_top = self.top_line
+        anchor_id, offset, at_bottom = anchor
+        idx = self.messages.bisect(anchor_id)
+        if at_bottom:
+            self.top_line = self.max_top_line()
+        elif idx < len(self.messages):
+            if self.messages.id_at(idx) != anchor_id:
+                offset = 0  # The anchor itself is gone, keep the one after it
+            offset = min(offset, self.lines.height(idx) - 1)
+            self.top_line = self.lines.start(idx) + offset
+        self.top_line = min(self.top_line, self.max_top_line())
+        # Content above the view moved, not the view itself
+        self._frame_top += self.top_line - old_top
+
+    def update_message(self, msg):
+        """Replace an edited message; removes it if there is nothing left to show"""
+        idx = self.messages.find(msg['id'])
+        if idx is None:
+            return
+        if not is_visible(msg):
+            self.remove_messages([msg['id']])
+            return
+        anchor = self._anchor()
+        self.messages.replace(idx, msg)
+        self._layout.pop((msg['id'], self.width), None)
+        self.lines.set_height(idx, len(self.wrapped(idx)))
+        self._restore(anchor)
+
+    def remove_messages(self, ids):
+        removed = sorted({self.messages.find(msg_id) for msg_id in set(ids)} - {None}, reverse=True)
+        if not removed:
+            return
+        anchor = self._anchor()
+        for idx in removed:
+            self._layout.pop((self.messages.id_at(idx), self.width), None)
+            self.messages.remove_at(idx)
+            self.lines.remove(idx)
+        self._restore(anchor)
+
+    def visible_media(self):
+        """(id, media) of the media messages in view"""
+        found = []
+        idx = max(0, self.lines.find(self.top_line))
+        while idx < len(self.messages) and self.lines.start(idx) < self.top_line + self.view_height:
+            media = self.messages.media_at(idx)
+            if media:
+                found.append((self.messages.id_at(idx), media))
+            idx += 1
+        return found
+
+    def visible_rows(self):
+        rows = []
+        idx = self.lines.find(self.top_line)
+        skip = self.top_line - self.lines.start(idx) if idx >= 0 else 0
+        count = len(self.messages)
+        while len(rows) < self.view_height and 0 <= idx < count:
+            rows.extend(self.wrapped(idx)[skip:])
+            skip = 0
+            idx += 1
+        rows = rows[:self.view_height]
+        return rows + [''] * (self.view_height - len(rows))
+
+    def draw(self):
+        with stats.timer('viewer.draw.seconds'):
+            self._draw()
+
+    def _draw(self):
+        header = f"Messages (↑/↓ to scroll, / for commands, q to exit) - {self.entity_name}"
+        if self.status:
+            header += f" [{self.status}]"
+        rows = [header, "=" * (self.width - 1)] + self.visible_rows()
+        rows.append(self.command_buffer if self.command_mode else '')
+
+        # A scroll step moves the body with the terminal's own scrolling,
+        # after which only the rows that came into view differ
+        shift = self.top_line - self._frame_top
+        if self._frame and 0 < abs(shift) < self.view_height:
+            self.scroll_body(shift)
+
+        # Only rewrite rows whose content changed since the last frame
+        for y, row in enumerate(rows):
+            if y < len(self._frame) and self._frame[y] == row:
+                continue
+            attr = curses.A_BOLD if y == 0 else 0
+            self.safe_addstr(y, 0, row.ljust(self.width - 1), attr)
+            stats.count('viewer.rows_written')
+        self._frame = rows
+        self._frame_top = self.top_line
 
         if self.command_mode:
-            self.safe_addstr(self.height-1, 0, self.command_buffer)
             curses.curs_set(1)
+            self.stdscr.move(self.height - 1, min(len(self.command_buffer), self.width - 1))
         else:
             curses.curs_set(0)
 
-        self.stdscr.refresh()
-        return current_y
-
+        self.stdscr.noutrefresh()
+        curses.doupdate()
 
+    def scroll_body(self, shift):
+        top, bottom = 2, 2 + self.view_height - 1
+        try:
+            self.stdscr.scrollok(True)
+            self.stdscr.setscrreg(top, bottom)
+            self.stdscr.scroll(shift)
+            self.stdscr.scrollok(False)
+        except curses.error:
+            self._frame = []
+            return
+        body = self._frame[top:bottom + 1]
+        if shift > 0:
+            body = body[shift:] + [None] * shift
+        else:
+            body = [None] * -shift + body[:shift]
+        self._frame[top:bottom + 1] = body
 
     def safe_addstr(self, y, x, text, attr=0):
         try:
@@ -90,6 +283,11 @@ class MessageViewer:
             pass
 
     def handle_key(self, key):
+        if key == curses.KEY_RESIZE:
+            self.resize()
+            self.top_line = min(self.top_line, self.max_top_line())
+            return None
+
         if self.command_mode:
             if key == 27:  # ESC
                 self.command_mode = False
@@ -113,139 +311,167 @@ class MessageViewer:
             self.command_mode = True
             self.command_buffer = "/"
         elif key == curses.KEY_UP:
-            if self.offset > 0:
-                self.offset -= 1
-            else:
-                # Instead of trying to load older messages here,
-                # return a special command to signal that we need older messages.
-                return '/load_older'
+            # Older history is prefetched in the background, see view_messages
+            if self.top_line > 0:
+                self.top_line -= 1
         elif key == curses.KEY_DOWN:
-            if self.offset < len(self.messages) - self.max_visible:
-                self.offset += 1
-        elif key == ord('o'):  # go bottom (newest messages)
-            self.offset = 0
-        elif key == ord('n'):  # go top (oldest messages)
-            self.offset = max(0, len(self.messages) - self.max_visible)
+            if self.top_line < self.max_top_line():
+                self.top_line += 1
+        elif key == ord('o'):  # go top (oldest messages)
+            self.top_line = 0
+        elif key == ord('n'):  # go bottom (newest messages)
+            self.top_line = self.max_top_line()
         elif key == ord('q'):  
             return 'quit'
             
         return None
-    
-    
-    def load_older_messages(self):
-        print(f'In load_older_messages, {self.oldest_message_id=}')
-        # Synchronously load older messages by running async code
-        if self.oldest_message_id:
-            older_messages = self.loop.run_until_complete(self.fetch_older_messages())
-            print(f'loaded {len(older_messages)} older messages')
-            if older_messages:
-                # Prepend older_messages to self.messages
-                self.messages = older_messages + self.messages
-                # Adjust offset to account for newly added messages
-                self.offset += len(older_messages)
-                # Update oldest_message_id
-                self.oldest_message_id = self.messages[0]['id']
-                print(f'new offset is {self.offset}')
-                return True
-        return False
-
-    async def fetch_older_messages(self, batch_size=10):
-        # Use oldest_message_id to load messages before that
-        older_msgs_raw = []
-        async for m in self.client.iter_messages(self.entity, limit=batch_size, max_id=self.oldest_message_id - 1):
-            if m.text:
-                sender = await m.get_sender()
-                sender_name = sender.username if sender and sender.username else (sender.first_name if sender else "Unknown")
-                older_msgs_raw.append({
-                    'id': m.id,
-                    'text': m.text,
-                    'sender': sender_name,
-                    'date': m.date
-                })
-        
-        # oldest first so reverse if needed
-        return list(reversed(older_msgs_raw))
+
+def is_visible(msg):
+    return bool(msg['text'] or msg['media'])  # Service messages have neither
+
+def visible_messages(messages):
+    return [m for m in messages if is_visible(m)]
 
 async def load_messages(client, entity, limit=10):
-    messages = []
-    async for message in client.iter_messages(entity, limit=limit):
-        if message.text:  # Only include text messages
-            sender = await message.get_sender()
-            sender_name = sender.username if sender and sender.username else (sender.first_name if sender else "Unknown")
-            messages.append({
-                'id': message.id,
-                'text': message.text,
-                'sender': sender_name,
-                'date': message.date
-            })
-    return messages
-
-
-
-async def view_messages(client, entity):
-    current_offset = -1
-    messages = await load_messages(client, entity, limit=10)  # Initial batch
-    loop = asyncio.get_event_loop()
-    viewer = None
-    async def fetch_older_messages(oldest_message_id, batch_size=100):
-        older_msgs = []
-        async for m in client.iter_messages(entity, limit=batch_size, max_id=oldest_message_id - 1):
-            if m.text:
-                sender = await m.get_sender()
-                sender_name = sender.username if sender and sender.username else (sender.first_name if sender else "Unknown")
-                older_msgs.append({
-                    'id': m.id,
-                    'text': m.text,
-                    'sender': sender_name,
-                    'date': m.date
-                })
-        return list(reversed(older_msgs))
-
-    def _view(stdscr, msgs):
-        nonlocal viewer
-        curses.use_default_colors()
-        viewer = MessageViewer(stdscr, msgs, entity, client, loop, current_offset)  # Pass client and loop here
-        while True:
-            viewer.draw()
-            try:
-                key = stdscr.getch()
-                if key == -1:  # No key pressed
-                        continue
-                result = viewer.handle_key(key)
-                
-                if result == 'quit':
-                    return 'quit'
-                elif result == '/load_older':
-                    return '/load_older'  # Signal we need more messages
-                elif result and result.startswith('/'):
-                    return result
-            except curses.error:
-                continue
-            # else continue looping
+    return visible_messages(await get_message_store().get_last(client, entity, limit))
+
+async def view_messages(client, entity, around_id=None):
+    """Run the message viewer until the user quits or enters a /command.
+
+    The viewer opens at the newest message, or with message around_id at
+    the top when given. New, edited and deleted messages are applied to
+    the store and the open view as Telegram reports them.
+    """
+    store = get_message_store()
+    if around_id is None:
+        page = await store.get_last(client, entity, PAGE_SIZE)
+    else:
+        page = (await store.get_older(client, entity, around_id + 1, PAGE_SIZE // 2)
+                + await store.get_newer(client, entity, around_id, PAGE_SIZE))
+    # Ids fetched so far at either end, media included, so pages without
+    # text still advance. None once there is nothing more to load.
+    oldest_id = page[0]['id'] if page else None
+    newest_id = page[-1]['id'] if page and around_id is not None else None
+    older = newer = None
+    redraw = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # A side whose last fetch failed is not fetched again before its
+    # retry time, which doubles with every failure in a row
+    failures = {'older': 0, 'newer': 0}
+    retry_at = {'older': 0.0, 'newer': 0.0}
+    retries = []
+
+    def fetch_failed(side):
+        failures[side] += 1
+        delay = min(PREFETCH_RETRY * 2 ** (failures[side] - 1), PREFETCH_RETRY_MAX)
+        retry_at[side] = loop.time() + delay
+        retries.append(loop.call_later(delay, redraw.set))
+        viewer.status = f"could not load {side} messages, retrying in {delay:.0f}s"
+
+    def older_done(task):
+        nonlocal oldest_id
+        viewer.status = ""
+        if not task.cancelled() and task.exception() is None:
+            failures['older'] = 0
+            messages = task.result()
+            oldest_id = messages[0]['id'] if messages else None
+            viewer.prepend_messages(visible_messages(messages))
+        elif not task.cancelled():
+            fetch_failed('older')
+        redraw.set()
+
+    def newer_done(task):
+        nonlocal newest_id
+        if not task.cancelled() and task.exception() is None:
+            if failures['newer']:
+                viewer.status = ""
+            failures['newer'] = 0
+            messages = task.result()
+            newest_id = messages[-1]['id'] if messages else None
+            viewer.append_messages(visible_messages(messages))
+        elif not task.cancelled():
+            fetch_failed('newer')
+        redraw.set()
+
+    chat_id = get_chat_id(entity)
 
-    while True:
-        command = curses.wrapper(lambda stdscr: _view(stdscr, messages))
-        
+    async def on_new_message(event):
+        msg = await store.save_live(client, chat_id, event.message)
+        # While newer history is still being paged in, the message will
+        # arrive with the last page instead
+        if newest_id is None and is_visible(msg):
+            viewer.add_live_message(msg)
+            redraw.set()
 
-        if command == 'quit':
+    async def on_edited(event):
+        viewer.update_message(await store.save_live(client, chat_id, event.message))
+        redraw.set()
+
+    async def on_deleted(event):
+        # Deletions outside channels come without a chat; their ids are
+        # unique across the account's private chats and groups
+        if event.chat_id is None and isinstance(entity, Channel):
+            return
+        if event.chat_id not in (None, chat_id):
             return
-        elif command == '/load_older':
-            # Fetch older messages async here
-            current_offset = viewer.offset
-            if messages:
-                oldest_message_id = min(msg['id'] for msg in messages)
-                older = await fetch_older_messages(oldest_message_id)
-                if older:
-                    messages =  older + messages
-                else:
-                    # No older messages found, maybe show a message or just continue
-                    # so user remains in the curses view
-                    print("No older messages found")
-            # After attempting to load older messages (whether found or not), go back to the view
-            continue
-        elif command and command.startswith('/'):
-            # Handle other commands
-            return command
+        store.delete_messages(chat_id, event.deleted_ids)
+        viewer.remove_messages(event.deleted_ids)
+        redraw.set()
+
+    def on_media_loaded(msg_id, msg):
+        if msg is None:
+            viewer.remove_messages([msg_id])
         else:
-            # No command returned (None), just continue to show UI again
-            continue
\ No newline at end of file
+            viewer.update_message(msg)
+        redraw.set()
+
+    handlers = [
+        (on_new_message, events.NewMessage(chats=entity)),
+        (on_edited, events.MessageEdited(chats=entity)),
+        (on_deleted, events.MessageDeleted()),
+    ]
+
+    with curses_screen() as stdscr, KeyReader(stdscr) as keys:
+        viewer = MessageViewer(stdscr, visible_messages(page), entity, client, around_id,
+                               get_media_cache())
+        for callback, event in handlers:
+            client.add_event_handler(callback, event)
+        media = MediaLoader(client, entity, on_media_loaded, viewer.media_cache)
+        try:
+            while True:
+                # Start loading the next page before the user reaches either end
+                margin = PREFETCH_SCREENS * viewer.view_height
+                now = loop.time()
+                if viewer.top_line < margin and oldest_id and (older is None or older.done()) \
+                        and now >= retry_at['older']:
+                    older = asyncio.ensure_future(
+                        store.get_older(client, entity, oldest_id, PAGE_SIZE))
+                    older.add_done_callback(older_done)
+                if viewer.top_line > viewer.max_top_line() - margin and newest_id \
+                        and (newer is None or newer.done()) and now >= retry_at['newer']:
+                    newer = asyncio.ensure_future(
+                        store.get_newer(client, entity, newest_id, PAGE_SIZE))
+                    newer.add_done_callback(newer_done)
+                if older is not None and not older.done() and viewer.top_line == 0:
+                    viewer.status = "loading older messages..."
+
+                viewer.draw()
+                # Thumbnails and metadata arrive later through on_media_loaded
+                media.request([msg_id for msg_id, info in viewer.visible_media()
+                               if media.wants(msg_id, info)])
+                for key in await keys.read(wakeup=redraw):
+                    result = viewer.handle_key(key)
+                    if result == 'quit':
+                        return None
+                    elif result and result.startswith('/'):
+                        return result
+        finally:
+            media.close()
+            for retry in retries:
+                retry.cancel()
+            for callback, event in handlers:
+                client.remove_event_handler(callback, event)
+            for task, callback in ((older, older_done), (newer, newer_done)):
+                if task is not None and not task.done():
+                    task.remove_done_callback(callback)
+                    task.cancel()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+from collections import deque
+from typing import AsyncIterator, List, Tuple
+
+from telethon import utils
+from telethon.tl.types import PeerChannel
+
+from instrumentation import stats
+
+# Windows of history fetched at the same time by a large pull
+FETCH_PARALLELISM = int(os.getenv('FETCH_PARALLELISM', '4'))
+# Messages aimed for per window, Telethon fetches them 100 per request
+FETCH_WINDOW = 500
+# Pulls of at least this many messages are split into windows
+PARALLEL_FETCH_MIN = 2 * FETCH_WINDOW
+
+Window = Tuple[int, int, List]
+
+
+def has_own_ids(entity) -> bool:
+    """Whether message ids count up within this chat alone. True for channels
+    and supergroups; private chats and basic groups share the account's ids,
+    so their ids say nothing about how many messages a window holds."""
+    try:
+        return isinstance(utils.get_peer(entity), PeerChannel)
+    except TypeError:
+        return False
+
+
+async def _fetch_window(client, entity, low: int, high: int) -> List:
+    """All messages with ids in [low, high], newest first"""
+    with stats.timer('telegram.window.seconds'):
+        messages = [m async for m in client.iter_messages(entity, min_id=low - 1, max_id=high + 1)]
+    stats.count('telegram.windows')
+    stats.count('telegram.history_pages', len(messages) // 100 + 1)  # Telethon pages by 100
+    return messages
+
+
+async def iter_windows(client, entity, limit: int, min_id: int = 0, max_id: int = 0,
+                       parallelism: int = FETCH_PARALLELISM) -> AsyncIterator[Window]:
+    """Yield (low, high, messages) for consecutive id windows strictly between
+    min_id and max_id, newest window first, until limit messages are out.
+
+    The newest id and the chat's message count give the density of ids,
+    from which the windows are sized to hold about FETCH_WINDOW messages
+    each; the estimate is corrected by every window that arrives. Up to
+    parallelism windows are fetched concurrently, but each is yielded
+    only once all newer ones have been, and holds every message in its
+    range. A max_id of 0 means "up to the newest message". Only meant for
+    chats with their own ids, see has_own_ids.
+    """
+    newest = await client.get_messages(entity, limit=1, max_id=max_id)
+    if not newest:
+        return
+    high = newest[0].id
+    total = getattr(newest, 'total', None) or high
+    density = min(1.0, max(total / high, 1e-6))
+    seen_messages = seen_ids = 0
+    delivered = 0
+    pending = deque()  # (low, high, task), newest window first
+
+    def schedule():
+        nonlocal high
+        # Stop once the windows in flight are expected to cover the rest
+        expected = delivered + len(pending) * FETCH_WINDOW
+        while len(pending) < max(1, parallelism) and high > min_id and expected < limit:
+            low = max(min_id + 1, high - int(FETCH_WINDOW / density) + 1)
+            pending.append((low, high, asyncio.ensure_future(
+                _fetch_window(client, entity, low, high))))
+            high = low - 1
+            expected += FETCH_WINDOW
+
+    try:
+        schedule()
+        while pending:
+            low, window_high, task = pending.popleft()
+            messages = await task
+            delivered += len(messages)
+            seen_messages += len(messages)
+            seen_ids += window_high - low + 1
+            if seen_messages:
+                density = min(1.0, seen_messages / seen_ids)
+            yield low, window_high, messages
+            if delivered >= limit:
+                return
+            schedule()
+    finally:
+        for _, _, task in pending:
+            task.cancel()
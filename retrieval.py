@@ -0,0 +1,119 @@
+import re
+import zlib
+from collections import Counter
+from typing import Dict, Hashable, List, Tuple
+
+import numpy as np
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD_RE.findall(text.lower())
+
+
+class HashedTfidfIndex:
+    """Offline TF-IDF retrieval over hashed word features, computed with NumPy.
+
+    Words are hashed into dim buckets, so there is no vocabulary to build
+    or store. Documents are kept as sparse (bucket, weight) entries in flat
+    arrays; a search scores every document by cosine similarity of its
+    TF-IDF vector with the query's in a few vectorized passes.
+    """
+
+    def __init__(self, dim: int = 2 ** 18):
+        self.dim = dim
+        self.df = np.zeros(dim, dtype=np.int32)
+        self._keys: List[Hashable] = []  # Key per row, None once removed
+        self._rows: Dict[Hashable, int] = {}
+        self._doc_buckets: List[np.ndarray] = []
+        self._doc_weights: List[np.ndarray] = []
+        self._flat = None  # (rows, buckets, weights) concatenated for search
+        self._removed = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key: Hashable):
+        return key in self._rows
+
+    def _vectorize(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        counts = Counter(zlib.crc32(word.encode('utf-8')) % self.dim for word in tokenize(text))
+        buckets = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        return buckets, 1 + np.log(tf)  # Sublinear term frequency
+
+    def add(self, key: Hashable, text: str):
+        if key in self._rows:
+            self.remove(key)
+        buckets, weights = self._vectorize(text)
+        self._rows[key] = len(self._keys)
+        self._keys.append(key)
+        self._doc_buckets.append(buckets)
+        self._doc_weights.append(weights)
+        self.df[buckets] += 1
+        self._flat = None
+
+    def remove(self, key: Hashable):
+        row = self._rows.pop(key)
+        self._keys[row] = None
+        self.df[self._doc_buckets[row]] -= 1
+        self._doc_buckets[row] = self._doc_buckets[row][:0]
+        self._doc_weights[row] = self._doc_weights[row][:0]
+        self._removed += 1
+        self._flat = None
+        if self._removed > len(self._rows):
+            self._compact()
+
+    def _compact(self):
+        live = [row for row, key in enumerate(self._keys) if key is not None]
+        self._keys = [self._keys[row] for row in live]
+        self._doc_buckets = [self._doc_buckets[row] for row in live]
+        self._doc_weights = [self._doc_weights[row] for row in live]
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+        self._removed = 0
+
+    def clear(self):
+        self.__init__(self.dim)
+
+    def _flatten(self):
+        if self._flat is None:
+            lengths = np.fromiter((len(b) for b in self._doc_buckets), dtype=np.int64,
+                                  count=len(self._doc_buckets))
+            rows = np.repeat(np.arange(len(self._doc_buckets), dtype=np.int32), lengths)
+            if self._doc_buckets:
+                buckets = np.concatenate(self._doc_buckets)
+                weights = np.concatenate(self._doc_weights)
+            else:
+                buckets = np.zeros(0, dtype=np.int32)
+                weights = np.zeros(0, dtype=np.float32)
+            self._flat = rows, buckets, weights
+        return self._flat
+
+    def search(self, query: str, k: int) -> List[Tuple[Hashable, float]]:
+        """Return up to k (key, score) pairs with a positive score, best first"""
+        if not self._rows or k <= 0:
+            return []
+        q_buckets, q_weights = self._vectorize(query)
+        if not len(q_buckets):
+            return []
+
+        n_docs = len(self._rows)
+        idf = np.log((n_docs + 1) / (self.df + 1), dtype=np.float32) + 1
+        rows, buckets, weights = self._flatten()
+        n_rows = len(self._keys)
+
+        doc_norms = np.sqrt(np.bincount(
+            rows, weights=(weights * idf[buckets]) ** 2, minlength=n_rows))
+        query_weights = np.zeros(self.dim, dtype=np.float32)
+        query_weights[q_buckets] = q_weights * idf[q_buckets] ** 2
+
+        hits = np.isin(buckets, q_buckets)
+        dots = np.bincount(rows[hits], weights=weights[hits] * query_weights[buckets[hits]],
+                           minlength=n_rows)
+        scores = np.divide(dots, doc_norms, out=np.zeros(n_rows), where=doc_norms > 0)
+
+        k = min(k, n_rows)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self._keys[row], float(scores[row])) for row in top if scores[row] > 0]
@@ -0,0 +1,110 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from instrumentation import stats
+
+UNKNOWN_SENDER = "Unknown"
+
+
+def get_sender_name(sender) -> str:
+    """Display name of a user or chat entity: username, then first name, then title"""
+    if sender is None:
+        return UNKNOWN_SENDER
+    return (getattr(sender, 'username', None)
+            or getattr(sender, 'first_name', None)
+            or getattr(sender, 'title', None)
+            or UNKNOWN_SENDER)
+
+
+class SenderCache:
+    """LRU cache of sender display names keyed by sender_id, with a TTL"""
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+
+    def get(self, sender_id: int) -> Optional[str]:
+        entry = self._entries.get(sender_id)
+        if entry is None:
+            return None
+        name, expires = entry
+        if expires < time.monotonic():
+            del self._entries[sender_id]
+            return None
+        self._entries.move_to_end(sender_id)
+        return name
+
+    def put(self, sender_id: int, name: str):
+        self._entries[sender_id] = (name, time.monotonic() + self.ttl)
+        self._entries.move_to_end(sender_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def resolve(self, client, messages: Iterable) -> Dict[int, str]:
+        """Map the sender_id of every message to a display name.
+
+        Senders already attached to the messages by Telethon are used as-is;
+        the remaining unknown ids are fetched with a single get_entity call.
+        """
+        names: Dict[int, str] = {}
+        missing: List[int] = []
+        for msg in messages:
+            sender_id = msg.sender_id
+            if sender_id is None or sender_id in names:
+                continue
+            name = self.get(sender_id)
+            if name is None and msg.sender is not None:
+                name = get_sender_name(msg.sender)
+                self.put(sender_id, name)
+            if name is None:
+                if sender_id not in missing:
+                    missing.append(sender_id)
+                continue
+            names[sender_id] = name
+
+        if missing:
+            names.update(await self._fetch(client, missing))
+        return names
+
+    async def _fetch(self, client, sender_ids: List[int]) -> Dict[int, str]:
+        stats.count('telegram.get_entity')
+        stats.count('senders.fetched', len(sender_ids))
+        try:
+            with stats.timer('telegram.get_entity.seconds'):
+                entities = await client.get_entity(sender_ids)
+        except (ValueError, TypeError):
+            # One unresolvable id fails the whole batch, so retry one by one
+            entities = []
+            for sender_id in sender_ids:
+                try:
+                    entities.append(await client.get_entity(sender_id))
+                except (ValueError, TypeError):
+                    entities.append(None)
+
+        names = {}
+        for sender_id, entity in zip(sender_ids, entities):
+            name = get_sender_name(entity)
+            if entity is not None:
+                self.put(sender_id, name)
+            names[sender_id] = name
+        return names
+
+
+sender_cache = SenderCache(
+    maxsize=int(os.getenv('SENDER_CACHE_SIZE', '4096')),
+    ttl=float(os.getenv('SENDER_CACHE_TTL', '3600')),
+)
+
+
+async def resolve_sender_names(client, messages: Iterable) -> Dict[int, str]:
+    """Resolve the senders of a page of messages through the shared cache"""
+    return await sender_cache.resolve(client, messages)
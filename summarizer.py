@@ -0,0 +1,186 @@
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional
+
+from llm_client import GenerationStats, get_llm_client
+from llm_context import estimate_tokens
+from llm_utils import (
+    summary_prompt, combine_summaries_prompt, update_summary_prompt,
+    stream_llm_response, SUMMARY_PROMPT_VERSION
+)
+from message_store import get_message_store
+
+# Prompt budget per LLM request, leaving room in the model's context window
+# for the instructions and the answer
+CHUNK_TOKENS = int(os.getenv('LLM_CHUNK_TOKENS', '3000'))
+# Number of chunk summaries requested from the LLM at the same time
+LLM_PARALLELISM = int(os.getenv('LLM_PARALLELISM', '2'))
+# A cached summary starting before the requested messages is still extended,
+# rather than redone, when what it covers before them spans at most this
+# fraction of the request, e.g. the last /summarize 500 after new messages
+SUMMARY_OVERHANG = float(os.getenv('LLM_SUMMARY_OVERHANG', '0.1'))
+
+ProgressCallback = Callable[[int, int], None]
+
+
+def chunk_lines(lines: List[str], max_tokens: int) -> List[List[str]]:
+    """Group lines into consecutive chunks of at most max_tokens each.
+
+    Chunks only break between lines, so no message is split; a single
+    line over the budget is cut down to fit.
+    """
+    chunks = []
+    current: List[str] = []
+    current_tokens = 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if tokens > max_tokens:
+            line = line[:max_tokens * 4]
+            tokens = max_tokens
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def _summarize_chunks(chunks: List[List[str]], make_prompt: Callable[[str], str],
+                            semaphore: asyncio.Semaphore,
+                            on_progress: Optional[ProgressCallback]) -> List[str]:
+    async def summarize(index: int, chunk: List[str]):
+        async with semaphore:
+            return index, await stream_llm_response(make_prompt("\n".join(chunk)))
+
+    summaries = [""] * len(chunks)
+    tasks = [asyncio.ensure_future(summarize(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        for done, next_result in enumerate(asyncio.as_completed(tasks), 1):
+            index, summary = await next_result
+            summaries[index] = summary.strip()
+            if on_progress:
+                on_progress(done, len(chunks))
+    finally:
+        for task in tasks:
+            task.cancel()
+    return summaries
+
+
+async def summarize_lines(lines: List[str], chunk_tokens: int = CHUNK_TOKENS,
+                          parallelism: int = LLM_PARALLELISM,
+                          on_progress: Optional[ProgressCallback] = None,
+                          on_chunk: Optional[Callable[[str], None]] = None,
+                          stats: Optional[GenerationStats] = None,
+                          semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    """Summarize chat lines of any length with a map-reduce over the LLM.
+
+    Lines are split into token-budgeted chunks which are summarized
+    concurrently (map). The partial summaries are then combined, in
+    further rounds if they still exceed the budget, until one request can
+    produce the final summary (reduce). Only the final request is streamed
+    to on_chunk and measured in stats; on_progress(done, total) is called
+    as map chunks finish. Passing a semaphore shares the limit on
+    concurrent LLM requests with other summaries; parallelism is then
+    ignored.
+    """
+    semaphore = semaphore or asyncio.Semaphore(max(1, parallelism))
+    chunks = chunk_lines(lines, chunk_tokens)
+    if len(chunks) <= 1:
+        async with semaphore:
+            return await stream_llm_response(
+                summary_prompt("\n".join(chunks[0] if chunks else lines)), on_chunk, stats)
+
+    summaries = await _summarize_chunks(chunks, summary_prompt, semaphore, on_progress)
+    while True:
+        chunks = chunk_lines(summaries, chunk_tokens)
+        if len(chunks) <= 1:
+            break
+        if len(chunks) == len(summaries):
+            # Summaries too long to share a chunk: pair them up to make progress
+            chunks = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+        summaries = await _summarize_chunks(chunks, combine_summaries_prompt, semaphore, None)
+    async with semaphore:
+        return await stream_llm_response(
+            combine_summaries_prompt("\n\n".join(summaries)), on_chunk, stats)
+
+
+async def extend_summary(previous_summary: str, lines: List[str],
+                         chunk_tokens: int = CHUNK_TOKENS,
+                         parallelism: int = LLM_PARALLELISM,
+                         on_progress: Optional[ProgressCallback] = None,
+                         on_chunk: Optional[Callable[[str], None]] = None,
+                         stats: Optional[GenerationStats] = None,
+                         semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    """Update previous_summary with the chat lines that followed it.
+
+    A delta that fits one request is folded in directly; a larger one is
+    summarized on its own first and then merged with the previous summary.
+    """
+    semaphore = semaphore or asyncio.Semaphore(max(1, parallelism))
+    budget = chunk_tokens - estimate_tokens(previous_summary)
+    if budget > 0 and len(chunk_lines(lines, budget)) <= 1:
+        async with semaphore:
+            return await stream_llm_response(
+                update_summary_prompt(previous_summary, "\n".join(lines)), on_chunk, stats)
+    delta_summary = await summarize_lines(lines, chunk_tokens, parallelism, on_progress,
+                                          semaphore=semaphore)
+    async with semaphore:
+        return await stream_llm_response(
+            combine_summaries_prompt(f"{previous_summary}\n\n{delta_summary}"), on_chunk, stats)
+
+
+async def summarize_messages(messages: List[Dict],
+                             on_chunk: Optional[Callable[[str], None]] = None,
+                             stats: Optional[GenerationStats] = None,
+                             on_progress: Optional[ProgressCallback] = None,
+                             semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    """Summarize messages using LLM, reusing cached summaries of the same chat.
+
+    A summary produced by the LLM is streamed to on_chunk as it is
+    generated; cached summaries are only returned. Errors are raised.
+    """
+    if not any(msg['text'] for msg in messages):
+        return "No text messages to summarize."
+
+    store = get_message_store()
+    chat_id, first_id, last_id = messages[0]['chat_id'], messages[0]['id'], messages[-1]['id']
+    cache_key = (get_llm_client().model, SUMMARY_PROMPT_VERSION)
+    summary = store.get_summary(chat_id, first_id, last_id, *cache_key)
+    if summary is not None:
+        return summary
+
+    overhang = int((last_id - first_id) * SUMMARY_OVERHANG)
+    previous = store.get_summary_overlapping(chat_id, first_id, last_id, *cache_key, overhang)
+    if previous is not None:
+        # Only the messages before and after the cached summary go to the LLM;
+        # any it covers before first_id stay in it
+        previous_first_id, previous_last_id, previous_summary = previous
+        head = [f"{msg['sender']}: {msg['text']}" for msg in messages
+                if msg['id'] < previous_first_id and msg['text']]
+        tail = [f"{msg['sender']}: {msg['text']}" for msg in messages
+                if msg['id'] > previous_last_id and msg['text']]
+        if head:
+            semaphore = semaphore or asyncio.Semaphore(max(1, LLM_PARALLELISM))
+            parts = await asyncio.gather(*(
+                summarize_lines(lines, on_progress=on_progress, semaphore=semaphore)
+                for lines in (head, tail) if lines))
+            # Consecutive parts of the chat, oldest first
+            parts.insert(1, previous_summary)
+            async with semaphore:
+                summary = await stream_llm_response(
+                    combine_summaries_prompt("\n\n".join(part.strip() for part in parts)),
+                    on_chunk, stats)
+        elif tail:
+            summary = await extend_summary(previous_summary, tail, on_progress=on_progress,
+                                           on_chunk=on_chunk, stats=stats, semaphore=semaphore)
+        else:
+            summary = previous_summary
+    else:
+        formatted_msgs = [f"{msg['sender']}: {msg['text']}" for msg in messages if msg['text']]
+        summary = await summarize_lines(formatted_msgs, on_progress=on_progress,
+                                        on_chunk=on_chunk, stats=stats, semaphore=semaphore)
+
+    store.save_summary(chat_id, first_id, last_id, *cache_key, summary)
+    return summary
@@ -1,16 +1,7 @@
 from telethon import TelegramClient
-from typing import List
+from typing import Dict, List
 from datetime import datetime
-import time
-import sys
-
-def stream_print(text: str, delay: float = 0.005):
-    """Print text with a streaming effect"""
-    for char in text:
-        sys.stdout.write(char)
-        sys.stdout.flush()
-        time.sleep(delay)
-    sys.stdout.write('\n')
+from message_store import get_message_store
 
 def format_chat_line(index: int, dialog) -> str:
     """Format chat line with bold unread count if any"""
@@ -24,39 +15,49 @@ async def list_chats(client):
         dialogs.append(dialog)
     return dialogs
 
-async def get_last_messages(client, entity, limit=10):
-    """Fetch last X messages from a specific chat"""
-    messages = []
-    async for message in client.iter_messages(entity, limit=limit):
-        messages.append(message)
-    messages.reverse()
+async def get_last_messages(client, entity, limit=10) -> List[Dict]:
+    """Fetch last X messages from a specific chat, syncing only new ones into the local store"""
+    store = get_message_store()
+    messages = await store.get_last(client, entity, limit)
+    if store.offline:
+        print("Telegram is unreachable, showing cached messages.")
     return messages
 
-async def format_message(msg):
-    """Format a single message with sender information"""
-    if not msg.text:
+def format_message(msg: Dict):
+    """Format a single stored message for the LLM context"""
+    if not msg['text']:
         return None
     
-    sender = (await msg.get_sender()) if msg.sender_id else None
-    sender_name = sender.username if sender and sender.username else (sender.first_name if sender else "Unknown")
-    
     return {
-        'date': msg.date.strftime('%Y-%m-%d %H:%M:%S'),
-        'sender': sender_name,
-        'text': msg.text
+        'chat_id': msg['chat_id'],
+        'id': msg['id'],
+        'date': msg['date'].strftime('%Y-%m-%d %H:%M:%S'),
+        'sender': msg['sender'],
+        'text': msg['text']
     }
 
+# Completed with Tab at the chat prompt
+CHAT_COMMANDS = ('/view', '/read', '/summarize', '/digest', '/search', '/searchall', '/add',
+                 '/show', '/prompt', '/clear', '/export', '/download', '/send', '/back',
+                 '/list', '/stats', '/help')
+
 def print_help():
     """Print help message for available commands"""
     print("\nChat-Level Commands:")
     print("/view         - View messages in this chat")
     print("/read x       - Read the last x messages from this chat")
     print("/summarize x  - Get an AI summary of the last x messages")
+    print("/digest       - Summarize the unread messages of all chats")
+    print("/search q     - Search cached messages of this chat")
+    print("/searchall q  - Search cached messages of all chats")
     print("/add x        - Add last x messages to global context")
     print("/show         - Show current context")
-    print("/prompt       - Send a prompt to LLM with current context")
+    print("/prompt [q]   - Ask the LLM about the current context, follow-ups continue")
     print("/clear        - Clear all stored context")
+    print("/export [f]   - Export the full history of this chat (jsonl or parquet)")
+    print("/download [n] - Download the file of message #n, or the newest one")
     print("/send         - Send a message to this chat")
     print("/back         - Return to the main chat selection menu")
     print("/list x       - List 50 chats starting from index x")
+    print("/stats        - Show timings and counters of this session")
     print("/help         - Show this help message\n")
\ No newline at end of file